@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+#
+# Compares the speed of extract_yt_initial_data against the old regex and
+# character-by-character implementation.
+#
+# By default the pages in benchmarks/fixtures are used. To try it on other pages,
+# save some from YouTube first, for example:
+#   curl -o home.html https://www.youtube.com
+#   curl -o results.html 'https://www.youtube.com/results?search_query=cats'
+# and then run:
+#   python3 benchmarks/bench_extract.py home.html results.html
+#
+# See bench_render.py for the rest of the page building code.
+#
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tubescraper
+
+# The implementation that extract_yt_initial_data replaced
+def legacy_unescape_string(string):
+    output = []
+    it = iter(string)
+    for c in it:
+        if c == '\\':
+            c = next(it)
+            if c == '\\':
+                output.append('\\')
+            elif c == '/':
+                output.append('/')
+            elif c == 'x':
+                n1 = next(it)
+                n2 = next(it)
+                n = ''.join([n1, n2])
+                output.append(chr(int(n,16)))
+            else:
+                raise Exception('unhandled ' + c)
+        else:
+            output.append(c)
+    return ''.join(output)
+
+def legacy_extract_yt_initial_data(input):
+    match = re.search(r"ytInitialData = '([^']*)'", input)
+    if match != None:
+        return legacy_unescape_string(match.group(1))
+    match = re.search(r"ytInitialData = ({.*?});</script>", input)
+    if match != None:
+        return match.group(1)
+    raise tubescraper.Error500
+
+# Returns the best time of several runs, in milliseconds
+def best_time(func, repeat=5):
+    number = 1
+    while timeit.timeit(func, number=number) < 0.2:
+        number *= 2
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1000
+
+def main(filenames):
+    if len(filenames) == 0:
+        fixtureDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+        filenames = [os.path.join(fixtureDir, name) for name in ('home.html', 'results.html')]
+    print('%-30s %10s %10s %10s %8s' % ('Page', 'Size (KB)', 'Old (ms)', 'New (ms)', 'Speedup'))
+    for filename in filenames:
+        with open(filename, encoding='utf-8') as f:
+            page = f.read()
+        if tubescraper.extract_yt_initial_data(page) != legacy_extract_yt_initial_data(page):
+            print('%s: output differs from the old implementation' % filename)
+            return 1
+        old = best_time(lambda: legacy_extract_yt_initial_data(page))
+        new = best_time(lambda: tubescraper.extract_yt_initial_data(page))
+        print('%-30s %10i %10.2f %10.2f %7.1fx' % (os.path.basename(filename), len(page) // 1024, old, new, old / new))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
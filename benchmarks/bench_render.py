@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+#
+# Measures the CPU time and memory used by the page extraction and rendering
+# code, using the saved YouTube responses in benchmarks/fixtures instead of
+# fetching anything. The fixtures are put into tubescraper's caches first, so
+# the same code runs as when a page is served, minus the network.
+#
+#   python3 benchmarks/bench_render.py                     # run everything
+#   python3 benchmarks/bench_render.py render              # only names containing "render"
+#   python3 benchmarks/bench_render.py --save before.json  # keep the results
+#   python3 benchmarks/bench_render.py --compare before.json
+#
+# Times are the best and median of several runs, per call. Memory is the peak
+# traced by tracemalloc during one call, and the number of memory blocks the
+# call leaves allocated when it returns ("Kept", mostly its result). Neither
+# counts how many allocations are made and freed again along the way, which
+# Python has no way to measure; the peak is the closest thing to it.
+#
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tubescraper
+
+fixtureDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# A change in the best time of more than this fraction is flagged by --compare.
+# Differences of up to about 15% between runs are normal on a busy machine.
+regressionThreshold = 0.20
+
+def load_text(filename):
+    with open(os.path.join(fixtureDir, filename), encoding='utf-8') as f:
+        return f.read()
+
+def load_json(filename):
+    return json.loads(load_text(filename))
+
+def render(contents):
+    out = []
+    tubescraper.render_contents(contents, out)
+    return out
+
+def render_channel_video_list(path):
+    out = []
+    tubescraper.make_channel_video_list(out, path, 1)
+    return out
+
+# Loads the fixtures and returns a list of (name, function) to benchmark
+def make_cases():
+    homeHTML = load_text('home.html')
+    resultsHTML = load_text('results.html')
+    homeData = tubescraper.extract_yt_initial_data(homeHTML)
+    resultsData = tubescraper.extract_yt_initial_data(resultsHTML)
+    homeJSON = json.loads(homeData)
+    resultsJSON = json.loads(resultsData)
+    homeContent = render(homeJSON['contents'])
+    watch = load_json('watch.json')
+    playlist = load_json('playlist.json')
+    channel = load_json('channel.json')
+    channelVideos = load_json('channel_videos.json')
+    comments = load_json('comments.json')
+
+    # A playlist page, as if get_playlist_info had fetched it
+    plist = playlist['id']
+    path = '/playlist?list=%s' % plist
+    key = ('https://www.youtube.com' + path, 'flat', json.dumps({'playlist_items': '1-%i' % (tubescraper.playlistPageSize + 1)}, sort_keys=True))
+    tubescraper.infoCache.put(key, playlist, 10**9, 1)
+    # The same playlist, for the watch page's playlist drawer
+    tubescraper.playlistIndexCache.put(plist, tubescraper.PlaylistIndex(playlist), 10**9, 1)
+    inPlaylist = playlist['entries'][5]['id']
+    # A channel's videos tab, as if its cursor had read it
+    cursor = tubescraper.ChannelTabCursor('/@bench/videos')
+    cursor.info = dict(channelVideos)
+    cursor.entries = cursor.info.pop('entries')
+    cursor.exhausted = True
+    tubescraper.channelTabCursors.put(cursor.path, cursor, 10**9)
+    # Comments, indexed the same way as CommentSession does
+    roots = [c for c in comments if c['parent'] == 'root']
+    replies = {}
+    for c in comments:
+        if c['parent'] != 'root':
+            replies.setdefault(c['parent'], []).append(c)
+
+    return [
+        ('extract_yt_initial_data home',    lambda: tubescraper.extract_yt_initial_data(homeHTML)),
+        ('extract_yt_initial_data results', lambda: tubescraper.extract_yt_initial_data(resultsHTML)),
+        ('json.loads home',                 lambda: json.loads(homeData)),
+        ('json.loads results',              lambda: json.loads(resultsData)),
+        ('render_contents home',            lambda: render(homeJSON['contents'])),
+        ('render_contents results',         lambda: render(resultsJSON['contents'])),
+        ('make_page home',                  lambda: tubescraper.make_page('Home', homeContent)),
+        ('make_watch_page',                 lambda: tubescraper.make_watch_page(watch, watch['id'])),
+        ('make_watch_page playlist',        lambda: tubescraper.make_watch_page(watch, inPlaylist, plist)),
+        ('make_playlist_video_list',        lambda: tubescraper.make_playlist_video_list(path, plist, 1)),
+        ('make_channel_page',               lambda: tubescraper.make_channel_page(channel, '/@bench', 1)),
+        ('make_channel_video_list',         lambda: render_channel_video_list(cursor.path)),
+        ('render_comment x10',              lambda: [tubescraper.render_comment(c, replies) for c in roots[:10]]),
+    ]
+
+# Returns the best and median time of several runs, in milliseconds per call
+def measure_time(func, repeat):
+    number = 1
+    while timeit.timeit(func, number=number) < 0.2:
+        number *= 2
+    times = [t / number * 1000 for t in timeit.repeat(func, number=number, repeat=repeat)]
+    return (min(times), statistics.median(times))
+
+# Returns the peak memory (in KiB) used during a call, and the number of blocks
+# it allocated which are still alive afterwards (not the number it allocated
+# in total)
+def measure_memory(func):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    del result
+    kept = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return (peak / 1024, kept)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks page extraction and rendering using saved fixtures.')
+    parser.add_argument('filter', nargs='?', default='', help='only run benchmarks whose names contain this')
+    parser.add_argument('--repeat', type=int, default=7, help='number of timed runs (default: 7)')
+    parser.add_argument('--save', metavar='FILE', help='write the results to a JSON file')
+    parser.add_argument('--compare', metavar='FILE', help='compare against results saved with --save')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    results = {}
+    regressions = 0
+    print('%-34s %10s %10s %10s %8s %8s' % ('Benchmark', 'Best (ms)', 'Med (ms)', 'Peak (KiB)', 'Kept', 'Change'))
+    for (name, func) in make_cases():
+        if args.filter not in name:
+            continue
+        func()  # warm up
+        (best, median) = measure_time(func, args.repeat)
+        (peak, kept) = measure_memory(func)
+        results[name] = {'best': best, 'median': median, 'peak': peak, 'kept': kept}
+        change = ''
+        if baseline != None and name in baseline:
+            ratio = best / baseline[name]['best'] - 1
+            change = '%+.1f%%' % (ratio * 100)
+            if ratio > regressionThreshold:
+                change += ' !'
+                regressions += 1
+        print('%-34s %10.3f %10.3f %10.1f %8i %8s' % (name, best, median, peak, kept, change))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if regressions > 0:
+        print('%i benchmark%s slower by more than %i%%' % (regressions, '' if regressions == 1 else 's', regressionThreshold * 100))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+#
+# A stand-in for YouTube's JSON API (Innertube) which answers search and browse
+# requests with the pages in benchmarks/fixtures, so that --innertube can be
+# tried and load tested without YouTube:
+#   python3 benchmarks/innertube_stub.py 8090
+#   python3 tubescraper.py 8080 --innertube --innertube-url http://localhost:8090
+#
+# Every search gets the same results and every browse gets the same home page.
+# Continuations give the same items again, numbered up to --pages pages.
+#
+
+import argparse
+import copy
+import http.server
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tubescraper
+
+fixtureDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def load_initial_data(filename):
+    with open(os.path.join(fixtureDir, filename), encoding='utf-8') as f:
+        return json.loads(tubescraper.extract_yt_initial_data(f.read()))
+
+def continuation_item(page):
+    return {'continuationItemRenderer': {'continuationEndpoint': {'continuationCommand': {'token': 'stub-page-%i' % page}}}}
+
+# Replaces the continuation at the end of a list of items with one for the given page
+def set_continuation(items, page, lastPage):
+    items = [item for item in items if 'continuationItemRenderer' not in item]
+    if page <= lastPage:
+        items.append(continuation_item(page))
+    return items
+
+class Stub:
+    def __init__(self, lastPage):
+        self.lastPage = lastPage
+        self.results = load_initial_data('results.html')
+        sections = self.results['contents']['twoColumnSearchResultsRenderer']['primaryContents']['sectionListRenderer']
+        sections['contents'] = set_continuation(sections['contents'], 2, lastPage)
+        self.searchItems = [item for item in sections['contents'] if 'continuationItemRenderer' not in item]
+        self.home = load_initial_data('home.html')
+        grid = self.home['contents']['twoColumnBrowseResultsRenderer']['tabs'][0]['tabRenderer']['content']['richGridRenderer']
+        grid['contents'] = set_continuation(grid['contents'], 2, lastPage)
+        self.homeItems = [item for item in grid['contents'] if 'continuationItemRenderer' not in item]
+
+    def continuation(self, items, token):
+        try:
+            page = int(token.rsplit('-', 1)[1])
+        except (IndexError, ValueError):
+            return None
+        items = set_continuation(copy.copy(items), page + 1, self.lastPage)
+        return {'onResponseReceivedCommands': [{'appendContinuationItemsAction': {'continuationItems': items}}]}
+
+    def respond(self, endpoint, body):
+        if endpoint == 'search':
+            return self.continuation(self.searchItems, body['continuation']) if 'continuation' in body else self.results
+        elif endpoint == 'browse':
+            return self.continuation(self.homeItems, body['continuation']) if 'continuation' in body else self.home
+        return None
+
+class StubRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        path = self.path.split('?')[0]
+        response = None
+        if path.startswith('/youtubei/v1/'):
+            response = self.server.stub.respond(path[len('/youtubei/v1/'):], body)
+        if response == None:
+            self.send_error(404)
+            return
+        content = json.dumps(response).encode(encoding='utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves saved fixtures in place of the Innertube API.')
+    parser.add_argument('port', type=int, nargs='?', default=8090, help='port to listen on (default: 8090)')
+    parser.add_argument('--pages', type=int, default=5, help='number of pages of results (default: 5)')
+    args = parser.parse_args()
+    with http.server.ThreadingHTTPServer(('', args.port), StubRequestHandler) as server:
+        server.stub = Stub(args.pages)
+        server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+#
+# Sends a mix of requests to a running tubescraper server from several
+# connections at once, and reports the throughput and latency of each route.
+#
+# To test without YouTube, record some browsing first and then replay it:
+#   python3 tubescraper.py 8080 --record rec      # and browse around a bit
+#   python3 tubescraper.py 8080 --replay rec
+#   python3 benchmarks/loadtest.py --paths rec/paths.txt --concurrency 32 --duration 30
+#
+# Without --paths, a fixed mix of pages is requested.
+#
+
+import argparse
+import http.client
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tubescraper import route_of
+
+defaultPaths = [
+    '/',
+    '/results?search_query=cats',
+    '/results?search_query=guitar+lesson',
+    '/watch?v=dQw4w9WgXcQ',
+    '/comments?v=dQw4w9WgXcQ',
+    '/playlist?list=PLFgquLnL59alCl_2TQvOiD5Vgm1hCaGSI',
+    '/@YouTube',
+    '/@YouTube/videos',
+]
+
+# Paths that are never requested, because they take as long as the video does
+skippedRoutes = {'flv'}
+
+def load_paths(filename):
+    with open(filename, encoding='utf-8') as f:
+        paths = [line.strip() for line in f]
+    return [p for p in paths if p.startswith('/') and route_of(p) not in skippedRoutes]
+
+# Returns the value at fraction p of the way through a sorted list
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+class Worker(threading.Thread):
+    def __init__(self, host, port, paths, rng, deadline, count, results):
+        super().__init__(daemon=True)
+        self.host = host
+        self.port = port
+        self.paths = paths
+        self.rng = rng
+        self.deadline = deadline
+        self.count = count
+        self.results = results  # list of (route, seconds, status)
+
+    def run(self):
+        conn = None
+        done = 0
+        while time.monotonic() < self.deadline and (self.count == None or done < self.count):
+            path = self.rng.choice(self.paths)
+            startTime = time.monotonic()
+            # A kept-alive connection may have been closed by the server in the
+            # meantime, in which case the request is tried again on a new one, as
+            # browsers do. Failures are recorded with a status of 0.
+            for attempt in range(2):
+                reused = conn != None
+                if conn == None:
+                    conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+                try:
+                    conn.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+                    response = conn.getresponse()
+                    response.read()
+                    status = response.status
+                    if response.will_close:
+                        conn.close()
+                        conn = None
+                    break
+                except (OSError, http.client.HTTPException):
+                    status = 0
+                    conn.close()
+                    conn = None
+                    if not reused:
+                        break
+            self.results.append((route_of(path), time.monotonic() - startTime, status))
+            done += 1
+        if conn != None:
+            conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Load tests a running tubescraper server.')
+    parser.add_argument('url', nargs='?', default='http://localhost:8080', help='server to test (default: http://localhost:8080)')
+    parser.add_argument('--paths', metavar='FILE', help='file of paths to request, one per line, such as paths.txt from a recording')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of connections at once (default: 8)')
+    parser.add_argument('--duration', type=float, default=10, help='how long to run for, in seconds (default: 10)')
+    parser.add_argument('--requests', type=int, help='stop after this many requests on each connection')
+    parser.add_argument('--seed', type=int, default=1, help='seed for choosing the paths (default: 1)')
+    args = parser.parse_args()
+
+    url = urllib.parse.urlsplit(args.url)
+    paths = load_paths(args.paths) if args.paths else defaultPaths
+    if len(paths) == 0:
+        print('no paths to request')
+        return 1
+    results = []
+    startTime = time.monotonic()
+    deadline = startTime + args.duration
+    workers = [Worker(url.hostname, url.port or 80, paths, random.Random(args.seed + i), deadline, args.requests, results)
+               for i in range(args.concurrency)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.monotonic() - startTime
+
+    byRoute = {}
+    for (route, seconds, status) in results:
+        byRoute.setdefault(route, []).append((seconds, status))
+    print('%d requests in %.1fs with %d connections' % (len(results), elapsed, args.concurrency))
+    print('%-10s %8s %8s %8s %10s %10s %10s' % ('Route', 'Requests', 'Errors', 'Req/s', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+    for route in sorted(byRoute):
+        times = sorted(seconds * 1000 for (seconds, status) in byRoute[route])
+        errors = sum(1 for (seconds, status) in byRoute[route] if not 200 <= status < 400)
+        print('%-10s %8d %8d %8.1f %10.1f %10.1f %10.1f' % (route, len(times), errors, len(times) / elapsed,
+            percentile(times, 0.50), percentile(times, 0.95), percentile(times, 0.99)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,17 +3,43 @@
 # YouTube simplifier
 #
 
+import argparse
+import asyncio
+import base64
+import bisect
+import collections
+import cProfile
+import concurrent.futures
+import contextlib
 import datetime
+import gzip
+import hashlib
+import hmac
 import html
+import http.cookiejar
 import http.server
+import io
 import json
+import os
+import pstats
+import queue
 import re
+import select
 import requests
+import requests.adapters
+import socket
 import socketserver
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import traceback
 import urllib
+import urllib3
 import yt_dlp
+import zlib
 
 class Error404(Exception):
     pass
@@ -21,6 +47,9 @@ class Error404(Exception):
 class Error500(Exception):
     pass
 
+class Error503(Exception):
+    pass
+
 # This bar appears at the top of every page
 headerBar = '''
 <div id="headerbar">
@@ -32,65 +61,269 @@ headerBar = '''
 </div>
 '''
 
-def serve_page(handler, status, content):
+# Returns a strong ETag for the given content
+def make_etag(content):
+    return '"%s"' % hashlib.sha1(content).hexdigest()
+
+# Checks if the client already has the version of the response with this ETag
+def etag_matches(handler, etag):
+    ifNoneMatch = handler.headers.get('If-None-Match')
+    if ifNoneMatch == None:
+        return False
+    tags = [t.strip() for t in ifNoneMatch.split(',')]
+    return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+# Checks if the client accepts gzipped responses
+def accepts_gzip(handler):
+    for coding in (handler.headers.get('Accept-Encoding') or '').split(','):
+        parts = coding.split(';')
+        if parts[0].strip().lower() in ('gzip', 'x-gzip'):
+            for param in parts[1:]:
+                (name, _, value) = param.strip().partition('=')
+                if name == 'q':
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+    return False
+
+# Dynamic pages at least this many bytes long are gzipped
+gzipMinSize = 1024
+gzipLevel = 6
+
+# Sends a complete response. If a gzipped version of the content is given, it
+# is sent instead to clients that accept it.
+def send_content(handler, status, contentType, content, etag=None, gzipped=None, cacheControl=None):
+    headers = []
+    if gzipped != None:
+        headers.append(('Vary', 'Accept-Encoding'))
+        if accepts_gzip(handler):
+            content = gzipped
+            headers.append(('Content-Encoding', 'gzip'))
+            if etag != None:
+                etag = etag[:-1] + '-gzip"'
+    if cacheControl != None:
+        headers.append(('Cache-Control', cacheControl))
+    if handler.close_connection:
+        headers.append(('Connection', 'close'))
+    if etag != None:
+        headers.append(('ETag', etag))
+        if status == 200 and etag_matches(handler, etag):
+            handler.send_response(304)
+            for header in headers:
+                handler.send_header(*header)
+            handler.end_headers()
+            return
     handler.send_response(status)
-    handler.send_header('Content-type', 'text/html')
+    handler.send_header('Content-type', contentType)
+    handler.send_header('Content-Length', str(len(content)))
+    for header in headers:
+        handler.send_header(*header)
     handler.end_headers()
-    handler.wfile.write(content)
+    with timed('socket_write'):
+        handler.wfile.write(content)
 
-# Constructs a page with the specified title and content
-def make_page(title, content, params=None, includeHeaderBar=True):
+def gzip_page(content):
+    return gzip.compress(content, gzipLevel, mtime=0) if len(content) >= gzipMinSize else None
+
+def serve_page(handler, status, content, etag=None, gzipped=None):
+    if status == 200 and etag == None:
+        etag = make_etag(content)
+    if gzipped == None:
+        gzipped = gzip_page(content)
+    send_content(handler, status, 'text/html', content, etag, gzipped)
+
+pageHeadHTML = '''<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" "http://www.w3.org/TR/html4/strict.dtd"><html>
+<head>
+  <meta http-equiv="Content-Type" content="text/html; charset=utf-8">
+  <meta name="viewport" content="user-scalable=0, width=device-width">
+  <link rel="icon" href="/favicon.ico">  <title>%s - TubeScraper</title>
+  <link rel="stylesheet" href="/style.css">
+  <!--[if lt IE 7]><link rel="stylesheet" href="/ie6.css"><![endif]-->
+</head>
+'''
+
+pageFootHTML = '</div></body><script type="text/javascript" src="/scripts.js"></script></html>'
+
+# Constructs everything in a page that comes before the content
+def make_page_head(title, params=None, includeHeaderBar=True):
     # If a search param is given, auto-populate the search field with it.
     if params == None:
         searchParam = ''
     else:
         searchParam = esc(params['search_query'][0])
-    # html begin
-    page = '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" "http://www.w3.org/TR/html4/strict.dtd">'
-    page += '<html>\n'
-    # head
-    page += '<head>\n'
-    page += '  <meta http-equiv="Content-Type" content="text/html; charset=utf-8">\n'
-    page += '  <meta name="viewport" content="user-scalable=0, width=device-width">\n'
-    page += '  <link rel="icon" href="/favicon.ico">'
-    page += '  <title>%s - TubeScraper</title>\n' % esc(title)
-    page += '  <link rel="stylesheet" href="/style.css">\n'
-    page += '  <!--[if lt IE 7]><link rel="stylesheet" href="/ie6.css"><![endif]-->\n'
-    page += '</head>\n'
+    head = pageHeadHTML % esc(title)
     # body
     if includeHeaderBar:
-        page += '<body>\n' + headerBar % searchParam
+        head += '<body>\n' + headerBar % searchParam
     else:
-        page += '<body style="margin: 0px">\n'  # get rid of header bar space
-    page += '<div id="content">\n' + content + '</div>'
-    page += '</body>'
-    # scripts
-    page += '<script type="text/javascript" src="/scripts.js"></script>'
-    # html end
-    page += '</html>'
-    return page.encode(encoding='utf-8')
+        head += '<body style="margin: 0px">\n'  # get rid of header bar space
+    return head + '<div id="content">\n'
+
+# Constructs a page with the specified title and content
+# The content may be a string, or a list of strings to be joined.
+def make_page(title, content, params=None, includeHeaderBar=True):
+    page = [make_page_head(title, params, includeHeaderBar)]
+    if type(content) is list:
+        page.extend(content)
+    else:
+        page.append(content)
+    page.append(pageFootHTML)
+    return ''.join(page).encode(encoding='utf-8')
+
+# Default size of the buffer that ChunkedWriter reads into
+writeBufferSize = 32 * 1024
+
+# Writes a response body to the client, either as it is with a Content-Length
+# already sent, or with chunked transfer encoding. The chunk framing is sent along
+# with the data in a single vectored write instead of being concatenated to it,
+# and data copied from files is read into a buffer that is allocated once and
+# reused for every chunk.
+class ChunkedWriter:
+    def __init__(self, handler, chunked=True, bufferSize=writeBufferSize):
+        self.handler = handler
+        self.chunked = chunked
+        self.bufferSize = bufferSize
+        self.buffer = None  # allocated on first use, since pages never need it
+        # sendmsg is only available on real sockets
+        self.sock = handler.connection if hasattr(handler.connection, 'sendmsg') else None
+        self.bytesSent = 0
+        self.startTime = time.monotonic()
+
+    # Sends data as one chunk
+    def write(self, data):
+        if len(data) == 0:
+            return
+        if self.chunked:
+            self.send([b'%X\r\n' % len(data), data, b'\r\n'])
+        else:
+            self.send([data])
+        self.bytesSent += len(data)
+
+    # Copies up to count bytes (or everything, if count is None) from a binary
+    # file or stream, one buffer at a time. sink, if given, is called with each
+    # piece of data sent, which is only valid until it returns.
+    # Returns the number of bytes copied.
+    def copy_from(self, f, count=None, sink=None):
+        if self.buffer == None:
+            self.buffer = memoryview(bytearray(self.bufferSize))
+        copied = 0
+        while count == None or copied < count:
+            view = self.buffer if count == None else self.buffer[:min(self.bufferSize, count - copied)]
+            n = f.readinto(view)
+            if not n:
+                break
+            self.write(view[:n])
+            if sink != None:
+                sink(view[:n])
+            copied += n
+        return copied
+
+    # Sends count bytes of a file from its current position. Without chunked
+    # encoding the kernel can copy straight from the file to the socket.
+    def send_file(self, f, count):
+        if self.chunked or self.sock == None:
+            return self.copy_from(f, count)
+        sent = self.sock.sendfile(f, f.tell(), count)
+        self.bytesSent += sent
+        return sent
+
+    # Ends the body
+    def close(self):
+        if self.chunked:
+            self.send([b'0\r\n\r\n'])
+
+    # Average rate, in bytes per second, that the body has been sent at
+    def throughput(self):
+        elapsed = time.monotonic() - self.startTime
+        return self.bytesSent / elapsed if elapsed > 0 else 0
+
+    def report(self, name):
+        print('sent %s: %.1f MiB in %.1fs (%.2f MiB/s)' % (name, self.bytesSent / 1048576,
+            time.monotonic() - self.startTime, self.throughput() / 1048576), flush=True)
+
+    def send(self, buffers):
+        with timed('socket_write'):
+            self.send_buffers(buffers)
+
+    def send_buffers(self, buffers):
+        if self.sock == None:
+            self.handler.wfile.writelines(buffers)
+            return
+        while len(buffers) > 0:
+            n = self.sock.sendmsg(buffers)
+            # drop whatever was sent, which may end partway through a buffer
+            while len(buffers) > 0 and n >= len(buffers[0]):
+                n -= len(buffers[0])
+                buffers.pop(0)
+            if n > 0:
+                buffers[0] = memoryview(buffers[0])[n:]
+
+# Set to False to send pages only once they are complete
+streamPages = True
+# Streamed pages are sent in chunks of about this many bytes
+pageStreamChunkSize = 8 * 1024
+
+# Sends a page in chunks while its content is still being built, so that the
+# browser can show the header bar and load the stylesheet in the meantime.
+# Content is added with append(), so a stream can be passed to render_contents
+# in place of a list. Chunked encoding needs HTTP/1.1, so check can_stream first.
+class PageStream:
+    def __init__(self, handler, title, params=None, includeHeaderBar=True):
+        self.handler = handler
+        self.parts = []    # everything sent so far
+        self.pending = 0   # length of the parts not yet sent
+        self.sent = 0      # number of parts already sent
+        # each chunk is compressed as it is sent, and flushed so that the
+        # browser can show it straight away
+        self.compressor = zlib.compressobj(gzipLevel, wbits=31) if accepts_gzip(handler) else None
+        # actual size of the page is not known, so we must send it in chunks
+        handler.send_response(200)
+        handler.send_header('Transfer-Encoding', 'chunked')
+        handler.send_header('Content-type', 'text/html')
+        handler.send_header('Vary', 'Accept-Encoding')
+        if self.compressor != None:
+            handler.send_header('Content-Encoding', 'gzip')
+        handler.end_headers()
+        handler.responseStarted = True
+        self.writer = ChunkedWriter(handler)
+        self.append(make_page_head(title, params, includeHeaderBar))
+        self.flush()
+
+    def append(self, text):
+        self.parts.append(text)
+        self.pending += len(text)
+        if self.pending >= pageStreamChunkSize:
+            self.flush()
+
+    def flush(self):
+        chunk = ''.join(self.parts[self.sent:]).encode(encoding='utf-8')
+        self.sent = len(self.parts)
+        self.pending = 0
+        if self.compressor != None:
+            chunk = self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.writer.write(chunk)
+
+    # Finishes the page and returns all of it
+    def close(self):
+        self.append(pageFootHTML)
+        self.flush()
+        if self.compressor != None:
+            self.writer.write(self.compressor.flush())
+        self.writer.close()
+        return ''.join(self.parts).encode(encoding='utf-8')
 
 # Decodes backslash escape sequences in strings
+# The \xNN escapes are rewritten as JSON \u00NN escapes, so that the whole string
+# can be decoded in one go by the json module instead of character by character.
 def unescape_string(string):
-    output = []
-    it = iter(string)
-    for c in it:
-        if c == '\\':
-            c = next(it)
-            if c == '\\':
-                output.append('\\')
-            elif c == '/':
-                output.append('/')
-            elif c == 'x':
-                n1 = next(it)
-                n2 = next(it)
-                n = ''.join([n1, n2])
-                output.append(chr(int(n,16)))
-            else:
-                raise Exception('unhandled ' + c)
-        else:
-            output.append(c)
-    return ''.join(output)
+    if '\\' not in string:
+        return string
+    # Split on escaped backslashes first so that "\\x" isn't mistaken for "\x"
+    parts = string.split('\\\\')
+    string = '\\\\'.join([p.replace('\\x', '\\u00').replace('"', '\\"') for p in parts])
+    return json.loads('"' + string + '"', strict=False)
 
 # like html.escape, but doesn't throw an exception when None is passed in
 def esc(string):
@@ -155,13 +388,23 @@ def get_text(obj):
 
 # Extracts the ytInitialData JSON from the page and returns it as a string
 def extract_yt_initial_data(input):
-    match = re.search(r"ytInitialData = '([^']*)'", input)
-    if match != None:
-        return unescape_string(match.group(1))
-    # Try it without the quote (some channels have it in this form)
-    match = re.search(r"ytInitialData = ({.*?});</script>", input)
-    if match != None:  # not found
-        return match.group(1)
+    marker = 'ytInitialData = '
+    start = input.find(marker)
+    while start >= 0:
+        start += len(marker)
+        if input.startswith("'", start):
+            # Quotes inside the string are escaped, so the next quote ends it
+            end = input.find("'", start + 1)
+            if end >= 0:
+                return unescape_string(input[start+1:end])
+        elif input.startswith('{', start):
+            # Try it without the quote (some channels have it in this form)
+            # The object is the last thing in its script element.
+            scriptEnd = input.find('</script>', start)
+            end = input.rfind('}', start, scriptEnd)
+            if scriptEnd >= 0 and end >= 0:
+                return input[start:end+1]
+        start = input.find(marker, start)
     raise Error500
 
 def nav_buttons(text, prevUrl, nextUrl):
@@ -174,25 +417,26 @@ def nav_buttons(text, prevUrl, nextUrl):
     content += '</div>'
     return content
 
+itemHTML = '''<div class="item item-video">
+ <a class="thumbnail" href="%s" target="_top">%s%s</a> <div class="details">%s </div>
+</div>
+'''
+
 # A channel, video, or playlist item within a list
 # Consists of a link containing the thumbnail
 # and another div containing text
 def make_item(title, url, thumbnailUrl=None, thumbnailText=None, channel=None, channelUrl=None, otherText=None):
-    content = '<div class="item item-video">\n'
-    content += ' <a class="thumbnail" href="%s" target="_top">' % esc(url)
-    if thumbnailUrl:
-        content += '<img src="%s" alt="Thumbnail">' % esc(thumbnailUrl)
-    if thumbnailText:
-        content += '<div class="thumbnail-overlay">%s</div>' % esc(thumbnailText)
-    content += '</a>'
-    content += ' <div class="details">'
-    line1 = '<a class="item-title" href="%s" target="_top">%s</a>' % (esc(url), esc(title))
-    line2 = esc(otherText) if otherText else None
-    line3 = '<a href="%s" target="_top">%s</a>\n' % (esc(channelUrl), esc(channel)) if channel else None
-    content += '<br>'.join(filter(None, [line1, line2, line3]))
-    content += ' </div>\n'
-    content += '</div>\n'
-    return content
+    url = esc(url)
+    lines = ['<a class="item-title" href="%s" target="_top">%s</a>' % (url, esc(title))]
+    if otherText:
+        lines.append(esc(otherText))
+    if channel:
+        lines.append('<a href="%s" target="_top">%s</a>\n' % (esc(channelUrl), esc(channel)))
+    return itemHTML % (
+        url,
+        '<img src="%s" alt="Thumbnail">' % esc(proxy_thumbnail(thumbnailUrl)) if thumbnailUrl else '',
+        '<div class="thumbnail-overlay">%s</div>' % esc(thumbnailText) if thumbnailText else '',
+        '<br>'.join(lines))
 
 def render_video_item(title, url, thumbUrl, viewsText, duration=None, date=None, channel=None, channelUrl=None):
     return make_item(
@@ -273,91 +517,662 @@ def render_playlistRenderer(playlist):
         channel      = playlist['longBylineText']['runs'][0]['text'],
         channelUrl   = playlist['longBylineText']['runs'][0]['navigationEndpoint']['commandMetadata']['webCommandMetadata']['url'])
 
+# Renders a node whose children are in obj[key]
+def render_children(key):
+    return lambda out, obj: render_contents(obj[key], out)
+
+# Renders a leaf node using a function which returns its HTML
+def render_item(func):
+    return lambda out, obj: out.append(func(obj))
+
+def render_tabRenderer(out, tab):
+    if 'title' in tab:
+        out.append('<div class="item"><h2>%s</h2></div>' % esc(tab['title']))
+    render_contents(tab['content'], out)
+
+def render_shelfRenderer(out, shelf):
+    out.append('<div class="drawer">%s' % esc(get_text(shelf['title'])))
+    render_contents(shelf['content'], out)
+    out.append('</div>')
+
+def render_brandVideoShelfRenderer(out, shelf):
+    out.append('<div class="drawer">%s<p>%s</p>' % (esc(get_text(shelf['title'])), esc(get_text(shelf['subtitle']))))
+    render_contents(shelf['content'], out)
+    out.append('</div>')
+
+# Renders a shelf of items which are shown side by side
+def render_reel_shelf(key):
+    def render(out, shelf):
+        out.append('<div class="drawer">%s<div class="reel-container">' % esc(get_text(shelf['title'])))
+        render_contents(shelf[key], out)
+        out.append('</div></div>')
+    return render
+
+def render_showingResultsForRenderer(obj):
+    return '<div class="item">Showing results for <a href="%s" style="font-style:italic">%s</a>. Search instead for <a href="%s" style="font-style:italic">%s</a>?</div>' % (
+        esc(obj['correctedQueryEndpoint']['commandMetadata']['webCommandMetadata']['url']),
+        esc(get_text(obj['correctedQuery'])),
+        esc(obj['originalQueryEndpoint']['commandMetadata']['webCommandMetadata']['url']),
+        esc(get_text(obj['originalQuery'])))
+
+def render_didYouMeanRenderer(obj):
+    return '<div class="item">Did you mean <a href="%s" style="font-style:italic">%s</a>?</div>' % (
+        esc(obj['correctedQueryEndpoint']['commandMetadata']['webCommandMetadata']['url']),
+        esc(get_text(obj['correctedQuery'])))
+
+def render_backgroundPromoRenderer(obj):
+    return '<div class="item"><b>%s</b><p>%s</p></div>' % (
+        esc(get_text(obj['title'])),
+        esc(get_text(obj['bodyText'])))
+
+# Renderers only see their own node, so the page being rendered sets the URL
+# which continuation tokens are added to, to make the link to the next page
+renderContext = threading.local()
+
+@contextlib.contextmanager
+def continuations_to(url):
+    renderContext.continuationUrl = url
+    try:
+        yield
+    finally:
+        renderContext.continuationUrl = None
+
+def render_continuationItemRenderer(out, obj):
+    url = getattr(renderContext, 'continuationUrl', None)
+    try:
+        token = obj['continuationEndpoint']['continuationCommand']['token']
+    except KeyError:
+        return
+    if url != None:
+        out.append('<div class="item"><a class="navbutton" href="%s">Next page &gt;</a></div>' % esc(url + urllib.parse.quote(token)))
+
+# Functions which render each kind of node, called as renderer(out, obj)
+renderers = {
+    # List renderers
+    'sectionListRenderer':               render_children('contents'),
+    'verticalListRenderer':              render_children('items'),
+    # Item renderers
+    'videoRenderer':                     render_item(render_videoRenderer),
+    'playlistRenderer':                  render_item(render_playlistRenderer),
+    'radioRenderer':                     render_item(render_compactPlaylistRenderer),
+    'channelRenderer':                   render_item(render_channelRenderer),
+    #
+    'twoColumnSearchResultsRenderer':    render_children('primaryContents'),
+    'itemSectionRenderer':               render_children('contents'),
+    'singleColumnBrowseResultsRenderer': render_children('tabs'),
+    'twoColumnBrowseResultsRenderer':    render_children('tabs'),
+    'tabRenderer':                       render_tabRenderer,
+    'richGridRenderer':                  render_children('contents'),
+    'richItemRenderer':                  render_children('content'),
+    'videoWithContextRenderer':          render_item(render_videoRenderer),
+    'richSectionRenderer':               render_children('content'),
+    # Shelf renderers
+    'shelfRenderer':                     render_shelfRenderer,
+    'brandVideoShelfRenderer':           render_brandVideoShelfRenderer,
+    'reelShelfRenderer':                 render_reel_shelf('items'),
+    'richShelfRenderer':                 render_reel_shelf('contents'),
+    #
+    'reelItemRenderer':                  render_item(render_reelItemRenderer),
+    'showingResultsForRenderer':         render_item(render_showingResultsForRenderer),
+    'didYouMeanRenderer':                render_item(render_didYouMeanRenderer),
+    'backgroundPromoRenderer':           render_item(render_backgroundPromoRenderer),
+    'continuationItemRenderer':          render_continuationItemRenderer,
+}
+
+# Number of times each kind of node without a renderer has been seen
+unknownRenderers = collections.Counter()
+unknownRenderersLock = threading.Lock()
+
 # Renders a contents node
-def render_contents(contents):
-    content = ''
-    for thing in contents:
-        if type(contents) is dict:  # iterating over keys of a dict
-            kind = thing
-            obj = contents[thing]
-        elif type(contents) is list:  # iterating over list of dicts, with each of the form { kind : {obj} }
-            kind = list(thing)[0]
-            obj = thing[kind]
-        # List renderers
-        if kind == 'sectionListRenderer':
-            content += render_contents(obj['contents'])
-        elif kind == 'verticalListRenderer':
-            content += render_contents(obj['items'])
-        # Item renderers
-        elif kind == 'videoRenderer':
-            content += render_videoRenderer(obj)
-        elif kind == 'playlistRenderer':
-            content += render_playlistRenderer(obj)
-        elif kind == 'radioRenderer':
-            content += render_compactPlaylistRenderer(obj)
-        elif kind == 'channelRenderer':
-            content += render_channelRenderer(obj)
-        #
-        elif kind == 'twoColumnSearchResultsRenderer':
-            content += render_contents(obj['primaryContents'])
-        elif kind == 'itemSectionRenderer':
-            content += render_contents(obj['contents'])
-        elif kind in ('singleColumnBrowseResultsRenderer', 'twoColumnBrowseResultsRenderer'):
-            content += render_contents(obj['tabs'])
-        elif kind == 'tabRenderer':
-            if 'title' in obj:
-                content += '<div class="item"><h2>%s</h2></div>' % esc(obj['title'])
-            content += render_contents(obj['content'])
-        elif kind == 'richGridRenderer':
-            content += render_contents(obj['contents'])
-        elif kind == 'richItemRenderer':
-            content += render_contents(obj['content'])
-        elif kind == 'videoWithContextRenderer':
-            content += render_videoRenderer(obj)
-        elif kind == 'richSectionRenderer':
-            content += render_contents(obj['content'])
-        # Shelf renderers
-        elif kind == 'shelfRenderer':
-            content += '<div class="drawer">%s%s</div>' % (esc(get_text(obj['title'])), render_contents(obj['content']))
-        elif kind == 'brandVideoShelfRenderer':
-            content += '<div class="drawer">%s<p>%s</p>%s</div>' % (
-                esc(get_text(obj['title'])),
-                esc(get_text(obj['subtitle'])),
-                render_contents(obj['content']))
-        elif kind == 'reelShelfRenderer':
-            content += '<div class="drawer">%s<div class="reel-container">%s</div></div>' % (esc(get_text(obj['title'])), render_contents(obj['items']))
-        elif kind == 'richShelfRenderer':
-            content += '<div class="drawer">%s<div class="reel-container">%s</div></div>' % (esc(get_text(obj['title'])), render_contents(obj['contents']))
-        #
-        elif kind == 'reelItemRenderer':
-            content += render_reelItemRenderer(obj)
-        elif kind == 'showingResultsForRenderer':
-            content += '<div class="item">Showing results for <a href="%s" style="font-style:italic">%s</a>. Search instead for <a href="%s" style="font-style:italic">%s</a>?</div>' % (
-                esc(obj['correctedQueryEndpoint']['commandMetadata']['webCommandMetadata']['url']),
-                esc(get_text(obj['correctedQuery'])),
-                esc(obj['originalQueryEndpoint']['commandMetadata']['webCommandMetadata']['url']),
-                esc(get_text(obj['originalQuery'])))
-        elif kind == 'didYouMeanRenderer':
-            content += '<div class="item">Did you mean <a href="%s" style="font-style:italic">%s</a>?</div>' % (
-                esc(obj['correctedQueryEndpoint']['commandMetadata']['webCommandMetadata']['url']),
-                esc(get_text(obj['correctedQuery'])))
-        elif kind == 'backgroundPromoRenderer':
-            content += '<div class="item"><b>%s</b><p>%s</p></div>' % (
-                esc(get_text(obj['title'])),
-                esc(get_text(obj['bodyText'])))
+# The HTML is appended to out if given, otherwise it is returned as a string.
+def render_contents(contents, out=None):
+    if out == None:
+        out = []
+        render_contents(contents, out)
+        return ''.join(out)
+    if type(contents) is dict:  # iterating over keys of a dict
+        nodes = contents.items()
+    elif type(contents) is list:  # iterating over list of dicts, with each of the form { kind : {obj} }
+        nodes = [next(iter(thing.items())) for thing in contents]
+    for (kind, obj) in nodes:
+        renderer = renderers.get(kind)
+        if renderer != None:
+            renderer(out, obj)
         else:
-            print('TODO: ' + kind)
-            #content += '<div class="item" style="font-family:monospace">Unknown renderer: %s</div>' % kind
-    return content
+            with unknownRenderersLock:
+                unknownRenderers[kind] += 1
+
+##### Caching #####
+
+# A thread-safe cache of key/value pairs that expire after a time-to-live.
+# Each entry has a cost (1 by default), and the least recently used entries are
+# evicted whenever the total cost goes over maxCost. If onEvict is given, it is
+# called with each value that is removed, after the lock has been released.
+class LRUCache:
+    def __init__(self, maxCost, onEvict=None):
+        self.maxCost = maxCost
+        self.cost = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()  # key -> (value, expireTime, cost)
+        self.lock = threading.Lock()
+        self.onEvict = onEvict
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Checks if key is cached, without counting it as a use
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry != None and entry[1] > time.monotonic()
+
+    # Returns the value for key, or None if it isn't cached or has expired
+    def get(self, key):
+        evicted = []
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None and entry[1] <= time.monotonic():
+                evicted.append(self._remove(key))
+                entry = None
+            if entry == None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        self._evicted(evicted)
+        return None if entry == None else entry[0]
+
+    def put(self, key, value, ttl, cost=1):
+        if ttl <= 0 or cost > self.maxCost:
+            return
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                old = self._remove(key)
+                if old is not value:
+                    evicted.append(old)
+            self.entries[key] = (value, time.monotonic() + ttl, cost)
+            self.cost += cost
+            while self.cost > self.maxCost:
+                evicted.append(self._remove(next(iter(self.entries))))
+        self._evicted(evicted)
+
+    def remove(self, key):
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                evicted.append(self._remove(key))
+        self._evicted(evicted)
+
+    # Removes an entry and returns its value
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.cost -= entry[2]
+        return entry[0]
+
+    def _evicted(self, values):
+        if self.onEvict != None:
+            for value in values:
+                self.onEvict(value)
+
+# Makes sure that only one call for a given key runs at a time. Anyone who asks
+# for the same key while it is running waits for it and gets the same result,
+# or has the same exception raised. This stops a burst of requests for the same
+# page from all going to YouTube before the first one has made it into a cache.
+class SingleFlight:
+    class Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0  # number of calls that shared another's result
+        self.lock = threading.Lock()
+
+    def do(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call == None
+            if leader:
+                call = self.calls[key] = SingleFlight.Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.event.wait()
+            if call.error != None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+# How long (in seconds) extract_info results are cached for, by kind
+infoCacheTTLs = {
+    'channel':  10 * 60,
+    'playlist': 10 * 60,
+    'watch':    60 * 60,
+}
+# Watch page entries are dropped this many seconds before their stream URLs expire
+streamExpiryMargin = 5 * 60
+# Approximate upper bound on the memory used by cached info, in bytes of JSON
+infoCacheMaxBytes = 64 * 1024 * 1024
+
+infoCache = LRUCache(infoCacheMaxBytes)
+
+# Returns the earliest expire= timestamp among the stream URLs in a watch page info
+def stream_expire_time(info):
+    expire = None
+    for fmt in info.get('formats') or []:
+        m = re.search(r'[?&/]expire[=/](\d+)', fmt.get('url') or '')
+        if m != None and (expire == None or int(m.group(1)) < expire):
+            expire = int(m.group(1))
+    return expire
+
+def info_cache_ttl(kind, info):
+    ttl = infoCacheTTLs[kind]
+    # Recorded stream URLs have usually expired by the time they are replayed,
+    # which would stop replayed watch pages from ever being cached
+    if kind == 'watch' and not (recording != None and recording.replaying):
+        expire = stream_expire_time(info)
+        if expire != None:
+            ttl = min(ttl, expire - time.time() - streamExpiryMargin)
+    return ttl
+
+# A thread-safe pool of YoutubeDL objects which all share the same options.
+# Creating a YoutubeDL is expensive (it registers every extractor, sets up the
+# cookie jar, and parses options), so instances are kept and reused.
+class YoutubeDLPool:
+    def __init__(self, opts, size):
+        self.opts = opts
+        self.size = size
+        self.created = 0
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+
+    # Creates instances until the pool is full
+    def fill(self):
+        while True:
+            with self.lock:
+                if self.created >= self.size:
+                    return
+                self.created += 1
+            self.idle.put(self._create())
+
+    # Checks out an instance for the duration of a with block. The options in
+    # overrides are set on the instance and restored when it is returned.
+    @contextlib.contextmanager
+    def checkout(self, overrides=None):
+        overrides = overrides or {}
+        ydl = self._acquire()
+        saved = {key: ydl.params[key] for key in overrides if key in ydl.params}
+        ydl.params.update(overrides)
+        try:
+            yield ydl
+        finally:
+            for key in overrides:
+                if key in saved:
+                    ydl.params[key] = saved[key]
+                else:
+                    del ydl.params[key]
+            self.idle.put(ydl)
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if create:
+            return self._create()
+        return self.idle.get()
+
+    def _create(self):
+        try:
+            return yt_dlp.YoutubeDL(dict(self.opts))
+        except:
+            with self.lock:
+                self.created -= 1
+            raise
+
+# yt_dlp options for each kind of extraction. Per-request options such as
+# playlist_items are passed as overrides when an instance is checked out.
+ydlProfiles = {
+    'flat':     {'extract_flat': True},
+    'watch':    {},
+    'comments': {'getcomments': True},
+}
+# Maximum number of YoutubeDL objects per profile
+ydlPoolSize = 4
+
+# Comments don't need a pool, since each CommentSession keeps its own YoutubeDL
+ydlPools = {profile: YoutubeDLPool(ydlProfiles[profile], ydlPoolSize) for profile in ('flat', 'watch')}
+
+# Calls yt_dlp's extract_info, sharing results between requests for the same URL and options
+def ydl_extract_info(url, profile, overrides, sanitize=False):
+    with ydlPools[profile].checkout(overrides) as ydl:
+        info = ydl.extract_info(url, download=False)
+        # sanitized info contains nothing that can't be stored as JSON
+        return ydl.sanitize_info(info) if sanitize else info
+
+# Extractions currently running, so that the same one is never run twice at once
+infoFetches = SingleFlight()
+
+def extract_info(kind, url, profile, overrides=None):
+    overrides = overrides or {}
+    key = (url, profile, json.dumps(overrides, sort_keys=True))
+    info = infoCache.get(key)
+    if info == None:
+        info = infoFetches.do(key, lambda: fetch_info(kind, key, url, profile, overrides))
+    return info
+
+def fetch_info(kind, key, url, profile, overrides):
+    with timed('upstream_ytdlp'):
+        if recording != None:
+            info = recording.call('info', [url, profile, overrides], lambda: ydl_extract_info(url, profile, overrides, True))
+        else:
+            info = ydl_extract_info(url, profile, overrides)
+    if info != None:
+        cost = len(json.dumps(info, default=str))
+        infoCache.put(key, info, info_cache_ttl(kind, info), cost)
+    return info
+
+# How long (in seconds) rendered pages are cached for, by route
+pageCacheTTLs = {
+    'home':     5 * 60,
+    'results':  10 * 60,
+    'playlist': 10 * 60,
+    'channel':  10 * 60,
+    'comments': 5 * 60,
+}
+# Maximum total size of cached pages, in bytes
+pageCacheMaxBytes = 32 * 1024 * 1024
+
+pageCache = LRUCache(pageCacheMaxBytes)
+
+# Adds a page to the page cache and returns its entry
+def cache_page(handler, route, content):
+    gzipped = gzip_page(content)
+    entry = (content, make_etag(content), gzipped)
+    pageCache.put(handler.path, entry, pageCacheTTLs[route], len(content) + len(gzipped or b''))
+    return entry
+
+# Serves the page for this request's path and query from the cache, calling
+# build() to construct it if it isn't cached
+def serve_cached_page(handler, route, build):
+    entry = pageCache.get(handler.path)
+    if entry == None:
+        entry = cache_page(handler, route, build())
+    serve_page(handler, 200, *entry)
+
+# Chunked encoding is only allowed in responses to HTTP/1.1 requests
+def can_stream(handler):
+    return handler.request_version == 'HTTP/1.1'
+
+# Like serve_cached_page, but build(out) appends the page's content to out.
+# When streaming is on, out is a PageStream which sends the content as it comes.
+def serve_streamed_page(handler, route, build, title, params=None, includeHeaderBar=True):
+    entry = pageCache.get(handler.path)
+    if entry != None:
+        serve_page(handler, 200, *entry)
+    elif streamPages and can_stream(handler):
+        stream = PageStream(handler, title, params, includeHeaderBar)
+        try:
+            build(stream)
+        except Error404:
+            # It's too late to change the status, so show the error in the page
+            stream.append('<p>404 Not Found</p>')
+            stream.close()
+            raise
+        except Exception:
+            stream.append('<p>500 Internal Server Error</p>')
+            stream.close()
+            raise
+        cache_page(handler, route, stream.close())
+    else:
+        out = []
+        build(out)
+        entry = cache_page(handler, route, make_page(title, out, params, includeHeaderBar))
+        serve_page(handler, 200, *entry)
+
+##### Record/Replay #####
+
+# Saves everything fetched from YouTube (pages, yt_dlp info, channel tab entries
+# and comments) to a directory, or serves it back from there instead of
+# fetching it, so that the server can be load tested without YouTube. Each
+# response is stored in a file named after a hash of what was asked for.
+# Video streams still come from YouTube, since ffmpeg reads them directly.
+class Recording:
+    def __init__(self, path, replaying, replayLatency=False):
+        self.path = path
+        self.replaying = replaying
+        self.recording = not replaying
+        # whether to take as long as the original fetch did when replaying it
+        self.replayLatency = replayLatency
+        self.pathsLock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, kind, key, ext):
+        return os.path.join(self.path, '%s-%s.%s' % (kind, hashlib.sha1(json.dumps(key).encode(encoding='utf-8')).hexdigest(), ext))
+
+    def save(self, kind, key, value):
+        (fd, partPath) = tempfile.mkstemp(suffix='.part', dir=self.path)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'key': key, 'value': value}, f, default=str)
+        os.replace(partPath, self.filename(kind, key, 'json'))
+
+    def load(self, kind, key):
+        try:
+            with open(self.filename(kind, key, 'json'), encoding='utf-8') as f:
+                return json.load(f)['value']
+        except FileNotFoundError:
+            raise Error404('no recording of %s %s' % (kind, json.dumps(key)))
+
+    # Returns the result of fetch(), recording it or replaying a recording of it.
+    # Errors that pages handle (not found, or yt_dlp failing) are recorded too.
+    def call(self, kind, key, fetch):
+        if self.replaying:
+            value = self.load(kind, key)
+            if self.replayLatency:
+                time.sleep(value['elapsed'])
+            if value['error'] == 'DownloadError':
+                raise yt_dlp.utils.DownloadError(value['message'])
+            elif value['error'] == 'Error404':
+                raise Error404(value['message'])
+            return value['result']
+        # Other errors, such as timeouts, are passed on without being recorded,
+        # so that they don't replace a good recording
+        startTime = time.monotonic()
+        try:
+            result = fetch()
+        except (yt_dlp.utils.DownloadError, Error404) as e:
+            self.save(kind, key, {
+                'result':  None,
+                'error':   type(e).__name__,
+                'message': str(e),
+                'elapsed': time.monotonic() - startTime})
+            raise
+        self.save(kind, key, {
+            'result':  result,
+            'error':   None,
+            'message': None,
+            'elapsed': time.monotonic() - startTime})
+        return result
+
+    # Passes on the items from a generator, recording each one as it is read, or
+    # replays the items that were read when it was recorded
+    def stream(self, kind, key, items):
+        filename = self.filename(kind, key, 'jsonl')
+        if self.replaying:
+            try:
+                with open(filename, encoding='utf-8') as f:
+                    for line in f:
+                        yield json.loads(line)
+            except FileNotFoundError:
+                raise Error404('no recording of %s %s' % (kind, json.dumps(key)))
+            return
+        with open(filename, 'w', encoding='utf-8') as f:
+            for item in items:
+                f.write(json.dumps(item, default=str) + '\n')
+                f.flush()
+                yield item
+
+    # Makes an HTTP request, or replays a recording of one. The body is stored
+    # decoded, so the response is given without a Content-Encoding. POST
+    # requests are told apart by their JSON body as well as their URL.
+    def http_request(self, method, url, params, kwargs):
+        fullUrl = requests.Request(method, url, params=params).prepare().url
+        key = fullUrl if method == 'GET' else [method, fullUrl, kwargs.get('json')]
+        def fetch():
+            r = httpSession.request(method, url, params=params, timeout=(httpConnectTimeout, httpReadTimeout), **kwargs)
+            with r:
+                headers = {k: v for (k, v) in r.headers.items() if k.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')}
+                return {'status': r.status_code, 'headers': headers, 'body': base64.b64encode(r.content).decode('ascii')}
+        value = self.call('http', key, fetch)
+        body = base64.b64decode(value['body'])
+        r = requests.Response()
+        r.url = fullUrl
+        r.status_code = value['status']
+        r.headers = requests.structures.CaseInsensitiveDict(value['headers'])
+        r.headers['Content-Length'] = str(len(body))
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        r._content = body
+        r.raw = io.BytesIO(body)
+        return r
+
+    # Keeps a list of the pages requested by clients, for the load tester to replay
+    def log_path(self, path):
+        with self.pathsLock:
+            with open(os.path.join(self.path, 'paths.txt'), 'a', encoding='utf-8') as f:
+                f.write(path + '\n')
+
+# Set by --record or --replay
+recording = None
+
+##### Upstream HTTP #####
+
+# Timeouts (in seconds) for connecting to and reading from YouTube
+httpConnectTimeout = 5
+httpReadTimeout = 20
+# Maximum number of keep-alive connections kept open to each host
+httpPoolSize = 16
+# Failed requests are retried this many times, waiting longer each time
+httpRetries = 2
+httpRetryBackoff = 0.5
+
+# Creates a session which keeps connections to YouTube alive between requests
+def make_http_session():
+    retry = urllib3.util.Retry(
+        total            = httpRetries,
+        backoff_factor   = httpRetryBackoff,
+        status_forcelist = (500, 502, 503, 504),
+        # The only POSTs are Innertube API calls, which only read
+        allowed_methods  = ('GET', 'HEAD', 'POST'),
+        raise_on_status  = False)
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=httpPoolSize, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    # Don't keep cookies, so that one user's requests don't affect another's
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+httpSession = make_http_session()
+
+def http_request(method, url, params=None, **kwargs):
+    with timed('upstream_http'):
+        if recording != None:
+            return recording.http_request(method, url, params, kwargs)
+        return httpSession.request(method, url, params=params, timeout=(httpConnectTimeout, httpReadTimeout), **kwargs)
+
+def http_get(url, params=None, **kwargs):
+    return http_request('GET', url, params, **kwargs)
+
+def http_post(url, params=None, **kwargs):
+    return http_request('POST', url, params, **kwargs)
+
+# Page fetches currently running, so that the same one is never run twice at once
+pageFetches = SingleFlight()
+
+# Fetches a YouTube page and returns its parsed ytInitialData, or None if it has none
+def fetch_initial_data(url):
+    return pageFetches.do(url, lambda: _fetch_initial_data(url))
+
+def _fetch_initial_data(url):
+    r = http_get(url)
+    if r.status_code == 404:
+        raise Error404
+    elif r.status_code != 200:
+        raise Error500
+    with timed('parse'):
+        data = extract_yt_initial_data(r.text)
+        #print(data)
+        return None if data == None else json.loads(data)
+
+##### Innertube API #####
+
+# The home page and search results can be fetched from the JSON API that
+# YouTube's own pages use (Innertube), instead of downloading the whole HTML
+# page and extracting ytInitialData from it. The responses have the same
+# contents, so they are rendered the same way. Continuations (the next page of
+# results) are always fetched from the API.
+innertubeMode = False  # set by --innertube
+# Set by --innertube-url, to use a local stub instead of YouTube
+innertubeBaseUrl = 'https://www.youtube.com'
+innertubeClient = {
+    'clientName':    'WEB',
+    'clientVersion': '2.20240726.00.00',
+    'hl':            'en',
+    'gl':            'US',
+}
+innertubeHomeBrowseId = 'FEwhat_to_watch'
+
+# Calls an Innertube endpoint (such as 'search' or 'browse') and returns the
+# parsed response
+def innertube_request(endpoint, body):
+    key = 'innertube:%s:%s' % (endpoint, json.dumps(body, sort_keys=True))
+    return pageFetches.do(key, lambda: _innertube_request(endpoint, body))
+
+def _innertube_request(endpoint, body):
+    r = http_post('%s/youtubei/v1/%s' % (innertubeBaseUrl, endpoint),
+        params  = {'prettyPrint': 'false'},
+        json    = dict(body, context={'client': innertubeClient}),
+        headers = {'X-YouTube-Client-Name': '1', 'X-YouTube-Client-Version': innertubeClient['clientVersion']})
+    if r.status_code == 404:
+        raise Error404
+    elif r.status_code != 200:
+        raise Error500
+    with timed('parse'):
+        return json.loads(r.text)
+
+# Returns the items in a continuation response
+def continuation_items(response):
+    items = []
+    for command in response.get('onResponseReceivedCommands', response.get('onResponseReceivedActions', [])):
+        for action in command.values():
+            if type(action) is dict:
+                items.extend(action.get('continuationItems', []))
+    return items
 
 ##### Channel Page #####
 
-def get_playlist_info(url, minItem=None, maxItem=None):
-    opts = {'extract_flat':True}
+def get_playlist_info(url, minItem=None, maxItem=None, kind='channel'):
+    overrides = {}
     if minItem != None and maxItem != None:
-        opts['playlist_items'] = '%i-%i' % (minItem, maxItem)
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        info = ydl.extract_info(url, download=False)
+        overrides['playlist_items'] = '%i-%i' % (minItem, maxItem)
+    info = extract_info(kind, url, 'flat', overrides)
     if info == None:
         raise Error404
     return info
@@ -378,17 +1193,17 @@ def make_channel_page(info, path, pageNum):
     # banner
     content = ''
     if banner:
-        content += '<img src="%s" style="width:100%%" alt="Channel Banner">' % esc(banner['url'])
+        content += '<img src="%s" style="width:100%%" alt="Channel Banner">' % esc(proxy_thumbnail(banner['url'], small=False))
     # channel header
     content += '<div class="channel-header">'
     if avatar:
-        content += '<img class="thumbnail" src="%s" style="width:100px" alt="Channel Avatar">' % esc(avatar['url'])
+        content += '<img class="thumbnail" src="%s" style="width:100px" alt="Channel Avatar">' % esc(proxy_thumbnail(avatar['url']))
     content += '<h1>%s</h1>%s subscribers' % (esc(info['channel']), suffix_number(info['channel_follower_count']) )
     content += '</div>'
     # description
     content += '<div class="drawer">Channel Description<p class="description">%s</p></div>' % esc(info['description'])
     # videos
-    if info['entries'][0]['_type'] == 'playlist':  # has multiple tabs
+    if has_multiple_tabs(info):
         for e in info['entries']:
             url = remove_yt_domain(e['webpage_url'])
             content += '<div class="drawer">%s' % esc(e['title'])
@@ -404,55 +1219,216 @@ def make_channel_page(info, path, pageNum):
     content += '</div>'
     return make_page(title, content)
 
-def make_channel_video_list(path, pageNum):
+def has_multiple_tabs(info):
+    return info['entries'][0]['_type'] == 'playlist'
+
+# Returns the paths of the lists shown in iframes on the channel page
+def channel_tab_paths(info, path):
+    if has_multiple_tabs(info):
+        paths = [remove_yt_domain(e['webpage_url']) for e in info['entries']]
+    else:
+        paths = [path + '/videos']
+    return paths + [path + '/playlists']
+
+# Channel tab cursors are kept for this long (in seconds) before being refetched
+channelTabCursorTTL = 10 * 60
+# Maximum number of channel tabs to keep cursors for
+channelTabCursorMax = 128
+
+# Cursors that are dropped from the cache are closed, so that their YoutubeDL
+# is cleaned up straight away
+channelTabCursors = LRUCache(channelTabCursorMax, lambda cursor: cursor.close())
+channelTabCursorsLock = threading.Lock()
+
+# The videos or playlists of a channel tab, fetched from YouTube only as far as
+# they have been read. yt_dlp produces the entries of a tab from a generator
+# which follows YouTube's continuations, so the cursor keeps that generator to
+# carry on from where the last page left off, instead of walking through all
+# the earlier pages again.
+class ChannelTabCursor:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.ydl = None
+        self.info = None
+        self.generator = None
+        self.exhausted = False
+        self.closed = False
+        self.entries = []
+
+    # Extracts the tab without processing it, which leaves its entries as an
+    # unconsumed generator. The cursor gets its own YoutubeDL because the
+    # generator keeps using it after extract_info returns.
+    def start(self):
+        if recording != None and recording.replaying:
+            self.ydl = None
+            self.info = recording.call('tab', self.path, None)
+            self.generator = recording.stream('tab', self.path, None)
+            return
+        self.ydl = yt_dlp.YoutubeDL(dict(ydlProfiles['flat']))
+        try:
+            info = self.ydl.extract_info('https://www.youtube.com' + self.path, download=False, process=False)
+            if info == None or info.get('_type') != 'playlist':
+                raise Error404('Failed to get playlist info from YouTube.')
+        except Exception:
+            self.finish()
+            raise
+        entries = info.pop('entries')
+        if recording != None:
+            recording.call('tab', self.path, lambda: info)
+            entries = recording.stream('tab', self.path, iter(entries))
+        if type(entries) is list:
+            self.entries = entries
+            self.finish()
+        else:
+            self.generator = iter(entries)
+        self.info = info
+
+    def finish(self):
+        self.exhausted = True
+        if self.ydl != None:
+            self.ydl.close()
+            self.ydl = None
+
+    # Called when the cursor is dropped from the cache. If a request is using
+    # it, the request closes it when it is done instead.
+    def close(self):
+        self.closed = True
+        if self.lock.acquire(blocking=False):
+            try:
+                self.finish()
+            finally:
+                self.lock.release()
+
+    # Returns the tab info and its entries from start up to (but not including) stop
+    def get(self, start, stop):
+        with self.lock, timed('upstream_ytdlp'):
+            try:
+                if self.info == None:
+                    self.start()
+                while not self.exhausted and len(self.entries) < stop:
+                    try:
+                        self.entries.append(next(self.generator))
+                    except StopIteration:
+                        self.finish()
+                return (self.info, self.entries[start:stop])
+            finally:
+                if self.closed:
+                    self.finish()
+
+def get_channel_tab_cursor(path):
+    with channelTabCursorsLock:
+        cursor = channelTabCursors.get(path)
+        if cursor == None:
+            cursor = ChannelTabCursor(path)
+            channelTabCursors.put(path, cursor, channelTabCursorTTL)
+    return cursor
+
+# Fetches a page of a channel's videos or playlists (10 per page, plus an extra
+# one so we can tell if it's the last page)
+def get_channel_video_list_info(path, pageNum):
+    min = (pageNum - 1) * 10 + 1
+    try:
+        (info, entries) = get_channel_tab_cursor(path).get(min - 1, min + 10)
+    except Exception:
+        # the generator can't be resumed after an error, so start again next time
+        channelTabCursors.remove(path)
+        raise
+    return dict(info, entries=entries)
+
+# Maximum number of channel tabs fetched at once in the background
+prefetchWorkers = 4
+# Maximum number of prefetches running or waiting to run. Any more are dropped,
+# since the tab will be fetched anyway when the browser asks for it.
+prefetchMaxPending = 16
+
+prefetchExecutor = concurrent.futures.ThreadPoolExecutor(prefetchWorkers, thread_name_prefix='prefetch')
+prefetchSlots = threading.BoundedSemaphore(prefetchMaxPending)
+
+def prefetch_channel_tab(path):
+    try:
+        get_channel_video_list_info(path, 1)
+    except Exception as e:
+        print('failed to prefetch %s: %r' % (path, e))
+    finally:
+        prefetchSlots.release()
+
+# Starts fetching the first page of each tab in the background, so that its
+# cursor already has the entries by the time the browser requests the iframes
+def prefetch_channel_tabs(info, path):
+    for tabPath in channel_tab_paths(info, path):
+        if tabPath in channelTabCursors:
+            continue
+        if not prefetchSlots.acquire(blocking=False):
+            print('not prefetching %s: too many prefetches pending' % tabPath)
+            continue
+        prefetchExecutor.submit(prefetch_channel_tab, tabPath)
+
+def make_channel_video_list(out, path, pageNum):
     # 10 videos per page
     min = (pageNum - 1) * 10 + 1
     max = min + 9
     # get an extra one so we can tell if it's the last page
-    info = get_playlist_info('https://www.youtube.com' + path, min, max + 1)
+    info = get_channel_video_list_info(path, pageNum)
     if len(info['entries']) <= 10:
         max = min + len(info['entries']) - 1
     if info == None:
         return Error404('Failed to get playlist info from YouTube.')
     entries = info['entries'][:10]
     if pageNum == 1 and len(entries) == 0:
-        content = '<p>No videos</p>'
+        out.append('<p>No videos</p>')
     else:
         sep = '&' if '?' in path else '?'
         prevUrl = '%s%spage=%i' % (path, sep, pageNum - 1) if pageNum > 1 else None
         nextUrl = '%s%spage=%i' % (path, sep, pageNum + 1) if len(info['entries']) > 10 else None
-        content = nav_buttons('Showing items %i to %i' % (min, max), prevUrl, nextUrl)
+        out.append(nav_buttons('Showing items %i to %i' % (min, max), prevUrl, nextUrl))
         if path.split('/')[-1] == 'playlists':
             # playlists
             for p in entries:
-                content += render_playlist_item(
+                out.append(render_playlist_item(
                     title = p['title'],
                     url = '/playlist?list=' + p['id'],
                     channel = info['channel'],
-                    channelUrl = remove_yt_domain(info['channel_url']))
+                    channelUrl = remove_yt_domain(info['channel_url'])))
         else:
             # videos
             for v in entries:
                 thumb = smallest_thumbnail(v['thumbnails'])
-                content += render_video_item(
+                out.append(render_video_item(
                     title      = v['title'],
                     url        = remove_yt_domain(v['url']),
                     thumbUrl   = thumb['url'].split('?')[0],  # Remove params. They cause the thumbnail to not show up on Webkit for some reason
-                    duration   = secs_to_hms(v['duration']),
-                    viewsText  = suffix_number(v['view_count']) + ' views',
-                    date       = v['release_timestamp'],
+                    duration   = secs_to_hms(v.get('duration')),
+                    viewsText  = suffix_number(v.get('view_count')) + ' views',
+                    date       = v.get('release_timestamp'),
                     channel    = info['channel'],
-                    channelUrl = remove_yt_domain(info['channel_url']))
-    return make_page('Videos', content, includeHeaderBar=False)
+                    channelUrl = remove_yt_domain(info['channel_url'])))
+
+# Number of videos on each page of a playlist
+playlistPageSize = 20
 
 def make_playlist_video_list(path, plist, pageNum):
-    info = get_playlist_info('https://www.youtube.com' + path)
+    min = (pageNum - 1) * playlistPageSize + 1
+    max = min + playlistPageSize - 1
+    # get an extra one so we can tell if it's the last page
+    info = get_playlist_info('https://www.youtube.com' + path, min, max + 1, kind='playlist')
     if info == None:
         raise Error404('Failed to get playlist info from YouTube.')
-    content = '<h1>%s</h1>%i videos' % (esc(info['title']), len(info['entries']))
-    for v in info['entries']:
+    with timed('render'):
+        return render_playlist_video_list(info, path, plist, pageNum, min)
+
+def render_playlist_video_list(info, path, plist, pageNum, min):
+    entries = info['entries'][:playlistPageSize]
+    max = min + len(entries) - 1
+    content = ['<h1>%s</h1>' % esc(info['title'])]
+    if info.get('playlist_count') != None:
+        content.append('%i videos' % info['playlist_count'])
+    prevUrl = '%s&page=%i' % (path, pageNum - 1) if pageNum > 1 else None
+    nextUrl = '%s&page=%i' % (path, pageNum + 1) if len(info['entries']) > playlistPageSize else None
+    content.append(nav_buttons('Showing items %i to %i' % (min, max), prevUrl, nextUrl))
+    for v in entries:
         thumb = smallest_thumbnail(v['thumbnails'])
-        content += render_video_item(
+        content.append(render_video_item(
             title      = v['title'],
             url        = remove_yt_domain(v['url']) + ('&list=%s' % plist),
             thumbUrl   = thumb['url'].split('?')[0],  # Remove params. They cause the thumbnail to not show up on Webkit for some reason
@@ -460,7 +1436,7 @@ def make_playlist_video_list(path, plist, pageNum):
             viewsText  = suffix_number(v['view_count']) + ' views',
             date       = v['release_timestamp'],
             channel    = info['channel'],
-            channelUrl = remove_yt_domain(info['channel_url']))
+            channelUrl = remove_yt_domain(info['channel_url'])))
     return make_page(info['title'], content)
 
 def serve_channel_page(handler, path, params):
@@ -488,14 +1464,19 @@ def serve_channel_page(handler, path, params):
 
     if len(rest) == 1:
         # Serve a subpage
-        serve_page(handler, 200, make_channel_video_list(path, pageNum))
+        serve_streamed_page(handler, 'channel', lambda out: make_channel_video_list(out, path, pageNum), 'Videos', includeHeaderBar=False)
     else:
         # Serve the channel page
-        url = 'https://m.youtube.com' + path + '?app=m'
-        info = get_playlist_info(url, 1, 10)
-        if info == None:
-            raise Error404
-        serve_page(handler, 200, make_channel_page(info, path, pageNum))
+        serve_cached_page(handler, 'channel', lambda: make_channel_main_page(path, pageNum))
+
+def make_channel_main_page(path, pageNum):
+    url = 'https://m.youtube.com' + path + '?app=m'
+    info = get_playlist_info(url, 1, 10)
+    if info == None:
+        raise Error404
+    prefetch_channel_tabs(info, path)
+    with timed('render'):
+        return make_channel_page(info, path, pageNum)
 
 ##### Playlist Page #####
 
@@ -509,56 +1490,82 @@ def serve_playlist_page(handler, params):
     if pageNum < 1:
         pageNum = 1
     plist = params['list'][0]
-    serve_page(handler, 200, make_playlist_video_list('/playlist?list=%s' % plist, plist, pageNum))
+    serve_cached_page(handler, 'playlist', lambda: make_playlist_video_list('/playlist?list=%s' % plist, plist, pageNum))
     return
 
+# The videos of a playlist and their positions, so that watch pages in the
+# playlist can find their neighbours without searching the whole list
+class PlaylistIndex:
+    def __init__(self, info):
+        self.title = info['title']
+        self.videos = [(v['id'], remove_yt_domain(v['url']), v['title']) for v in info['entries']]
+        self.positions = {v[0]: i for (i, v) in enumerate(self.videos)}
+
+# Maximum total number of videos in cached playlist indexes
+playlistIndexCacheMaxVideos = 200000
+
+playlistIndexCache = LRUCache(playlistIndexCacheMaxVideos)
+
+def get_playlist_index(plist):
+    index = playlistIndexCache.get(plist)
+    if index == None:
+        info = get_playlist_info('https://www.youtube.com/playlist?list=%s' % plist, kind='playlist')
+        index = PlaylistIndex(info)
+        playlistIndexCache.put(plist, index, infoCacheTTLs['playlist'], max(len(index.videos), 1))
+    return index
+
 ##### Home Page #####
 
-def serve_main_page(handler):
+def make_main_page(out, params):
     # fetch results from YouTube
-    r = requests.get('https://www.youtube.com')
-    if r.status_code == 200:
-        data = extract_yt_initial_data(r.text)
-        #print(data)
-        resultsJSON = json.loads(data)
-        content = render_contents(resultsJSON['contents'])
-        serve_page(
-            handler,
-            200,
-            make_page('Home', content))
-    elif r.status_code == 404:
-        raise Error404
+    if 'ctoken' in params:
+        contents = continuation_items(innertube_request('browse', {'continuation': params['ctoken'][0]}))
     else:
-        raise Error500
-    return
+        if innertubeMode:
+            resultsJSON = innertube_request('browse', {'browseId': innertubeHomeBrowseId})
+        else:
+            resultsJSON = fetch_initial_data('https://www.youtube.com')
+        if resultsJSON == None:
+            raise Error500
+        contents = resultsJSON['contents']
+    with timed('render'), continuations_to('/?ctoken='):
+        render_contents(contents, out)
+
+def serve_main_page(handler, params=None):
+    if params == None:
+        params = {}
+    serve_streamed_page(handler, 'home', lambda out: make_main_page(out, params), 'Home')
 
 ##### Results Page #####
 
-def make_results_page(params, input):
+def make_results_page(out, params, query):
     rawParam = urllib.parse.unquote(params['search_query'][0])
-    content = '<p><b>Search results for "%s"</b></p>' % esc(rawParam)
-    data = extract_yt_initial_data(input)
-    if data == None:
-        content += '<p>No results found</p>'
+    out.append('<p><b>Search results for "%s"</b></p>' % esc(rawParam))
+    # links to the next page keep the search query and filters
+    nextUrl = '/results?%s&ctoken=' % urllib.parse.urlencode({k: v[0] for (k, v) in params.items() if k in ('search_query', 'sp')})
+    # fetch results from YouTube
+    if 'ctoken' in params:
+        items = continuation_items(innertube_request('search', {'continuation': params['ctoken'][0]}))
+        with timed('render'), continuations_to(nextUrl):
+            render_contents(items, out)
+        return
+    if innertubeMode:
+        body = {'query': params['search_query'][0]}
+        if 'sp' in params:
+            body['params'] = params['sp'][0]
+        resultsJSON = innertube_request('search', body)
     else:
-        # JSON
-        #print(data)
-        resultsJSON = json.loads(data)
-        content += '<p>Estimated %s results</p>' % esc(resultsJSON['estimatedResults'])
-        contents = resultsJSON['contents']
-        content += render_contents(resultsJSON['contents'])
-        return make_page(rawParam, content, params=params)
+        resultsJSON = fetch_initial_data('https://www.youtube.com/results?' + query)
+    if resultsJSON == None or 'contents' not in resultsJSON:
+        out.append('<p>No results found</p>')
+    else:
+        out.append('<p>Estimated %s results</p>' % esc(resultsJSON['estimatedResults']))
+        with timed('render'), continuations_to(nextUrl):
+            render_contents(resultsJSON['contents'], out)
 
 def serve_results_page(handler, params, query):
-    # fetch results from YouTube
-    r = requests.get('https://www.youtube.com/results?' + query)
-    if r.status_code == 200:
-        serve_page(handler, 200, make_results_page(params, r.text))
-    elif r.status_code == 404:
-        raise Error404
-    else:
-        exit()
-    return
+    rawParam = urllib.parse.unquote(params['search_query'][0])
+    serve_streamed_page(handler, 'results', lambda out: make_results_page(out, params, query), rawParam, params)
 
 ##### Watch Page #####
 
@@ -590,13 +1597,53 @@ def print_format_info(formats):
         fps = fps if fps != None else 0
         print('%-10s %-15s %-15s %6i %6i %4i %-5s %s' % (fmt['format_id'], fmt['acodec'], fmt['vcodec'], w, h, fps, fmt['ext'], fmt.get('format_note')))
 
+# Number of playlist videos listed on a watch page, around the current one
+watchPlaylistSize = 20
+
+def make_watch_playlist(videoId, plist):
+    index = get_playlist_index(plist)
+    videos = index.videos
+    pos = index.positions.get(videoId)
+    prevUrl = nextUrl = None
+    if pos == None:
+        text = '%i videos' % len(videos)
+        start = 0
+    else:
+        text = '%i / %i' % (pos + 1, len(videos))
+        if pos > 0:
+            prevUrl = videos[pos - 1][1] + '&list=' + plist
+        if pos + 1 < len(videos):
+            nextUrl = videos[pos + 1][1] + '&list=' + plist
+        start = max(0, min(pos - watchPlaylistSize // 4, len(videos) - watchPlaylistSize))
+    content = '<div class="drawer">Playlist\n'
+    content += nav_buttons(text, prevUrl, nextUrl)
+    # videos
+    content += '  <ol class="watch-playlist" start="%i">\n' % (start + 1)
+    for (id, url, title) in videos[start:start+watchPlaylistSize]:
+        content += '    <li%s><a href="%s">%s</a></li>\n' % (
+            ' class="selected"' if id == videoId else '',
+            esc(url + '&list=' + plist),
+            esc(title))
+    content += '  </ol>\n'
+    # link to the page of the full playlist that this video is on
+    page = (pos if pos != None else 0) // playlistPageSize + 1
+    content += '<a href="%s">View full playlist</a>\n' % esc('/playlist?list=%s&page=%i' % (plist, page))
+    content += '</div>\n'
+    return content
+
 def serve_watch_page(handler, videoId, plist=None):
     try:
-        with yt_dlp.YoutubeDL() as ydl:
-            url = 'https://m.youtube.com/watch?app=m&v=' + videoId
-            info = ydl.extract_info(url, download=False)
+        info = extract_info('watch', 'https://m.youtube.com/watch?app=m&v=' + videoId, 'watch')
     except yt_dlp.utils.DownloadError:
         raise Error404
+    print_format_info(info['formats'])
+    if plist:
+        get_playlist_index(plist)  # fetched first, so that it isn't timed as rendering
+    with timed('render'):
+        page = make_watch_page(info, videoId, plist)
+    serve_page(handler, 200, page)
+
+def make_watch_page(info, videoId, plist=None):
     # Get captions
     captionsHTML = ''
     for st in info['subtitles']:
@@ -615,14 +1662,15 @@ def serve_watch_page(handler, videoId, plist=None):
                     lang = fmt['name'] + ' (auto-generated)'
                     captionsHTML += '\n  <track label="%s" kind="subtitles" srclang="%s" src="%s"></track>' % (esc(lang), esc(st), esc(url))
     # Get video formats
-    print_format_info(info['formats'])
     formats = {fmt['format_id']:fmt for fmt in info['formats']}
     uploadDate = datetime.datetime.strptime(info['upload_date'], '%Y%m%d')
     fmt = formats['18']
     # video
-    flashUrl = '/flvconvert.flv?src=' + fmt['url']
-    flashVars = esc('margin=0&showstop=1&showiconplay=1&showtime=1&flv=%s' % urllib.parse.quote(flashUrl))
-    content = videoHTML % (esc(info['thumbnail']), esc(fmt['url']), captionsHTML, flashVars)
+    # In phpstream mode the player seeks by adding the byte position of a
+    # keyframe (from the index in the video's metadata) to the end of this URL
+    flashUrl = '/flvconvert.flv?v=%s&fmt=%s&start=' % (videoId, fmt['format_id'])
+    flashVars = esc('margin=0&showstop=1&showiconplay=1&showtime=1&phpstream=1&flv=%s' % urllib.parse.quote(flashUrl))
+    content = videoHTML % (esc(proxy_thumbnail(info['thumbnail'], small=False)), esc(fmt['url']), captionsHTML, flashVars)
     # info
     content += videoInfoHTML % (
         esc(info['title']),
@@ -632,37 +1680,12 @@ def serve_watch_page(handler, videoId, plist=None):
         esc(info['uploader']))
     # playlist
     if plist:
-        info = get_playlist_info('https://www.youtube.com/playlist?list=%s' % plist)
-        if info:
-            videos = info['entries']
-            prevUrl = nextUrl = None
-            index = None
-            for i in range(0, len(videos)):
-                v = videos[i]
-                if v['id'] == videoId:
-                    index = i
-            for i in range(0, len(videos)):
-                if index - 1 == i:
-                    prevUrl = remove_yt_domain(videos[i]['url']) + '&list=' + plist
-                elif index + 1 == i:
-                    nextUrl = remove_yt_domain(videos[i]['url']) + '&list=' + plist
-            content += '<div class="drawer">Playlist\n'
-            content += nav_buttons('%i / %i' % (index + 1, len(videos)), prevUrl, nextUrl)
-            # videos
-            content += '  <ol class="watch-playlist">\n'
-            for v in info['entries']:
-                url = remove_yt_domain(v['url']) + '&list=' + plist
-                content += '    <li%s><a href="%s">%s</a></li>\n' % (
-                    ' class="selected"' if v['id'] == videoId else '',
-                    esc(url),
-                    esc(v['title']))
-            content += '  </ol>\n'
-            content += '</div>\n'
+        content += make_watch_playlist(videoId, plist)
     # description
     content += '<div class="drawer">Description<p class="description">%s</p></div>' % info['description']
     # comments
     content += '<div class="drawer">Comments<iframe src="/comments?v=%s"></div>\n' % videoId
-    serve_page(handler, 200, make_page(info['title'], content))
+    return make_page(info['title'], content)
 
 ##### Comments Page #####
 
@@ -691,44 +1714,151 @@ commentHTML = '''
 </div>
 '''
 
-def render_comment(comment):
-    repliesHTML = ''.join([render_comment(c) for c in comment['replies']]) if 'replies' in comment else ''
+# Renders a comment along with its replies, which are looked up by parent ID in replies
+def render_comment(comment, replies):
+    repliesHTML = ''.join([render_comment(c, replies) for c in replies.get(comment['id'], [])])
     return commentHTML % (
         esc(comment['author_id']),
-        esc(comment['author_thumbnail']),
+        esc(proxy_thumbnail(comment['author_thumbnail'])),
         esc(comment['author']),
         esc(comment['time_text']),
         esc(comment['text']),
         '%i Like%s' % (comment['like_count'], '' if comment['like_count'] == 1 else 's'),
         repliesHTML)
-    return content
+
+# Comment sessions are kept for this long (in seconds) after they are last used
+commentSessionTTL = 15 * 60
+# Maximum number of videos to keep comment sessions for
+commentSessionMax = 64
+
+# Sessions that are dropped from the cache are closed, like channel tab cursors
+commentSessions = LRUCache(commentSessionMax, lambda session: session.close())
+commentSessionsLock = threading.Lock()
+
+# yt_dlp has no API for reading comments a page at a time. Its YouTube extractor
+# calls extract_comments() while extracting a video, which makes a generator with
+# the private _get_comments() and returns a function that reads all of it. This
+# replaces extract_comments() on the extractor ie so that capture(generator) is
+# called instead, after checking that both methods still exist.
+def hook_comment_generator(ie, capture):
+    if not callable(getattr(ie, 'extract_comments', None)) or not callable(getattr(ie, '_get_comments', None)):
+        raise Error500('this version of yt_dlp has no comment extraction hooks')
+    def capture_generator(*args, **kwargs):
+        capture(ie._get_comments(*args, **kwargs))
+    ie.extract_comments = capture_generator
+
+# The comments of a video, fetched from YouTube only as far as they have been
+# read. yt_dlp produces comments from a generator which follows YouTube's
+# continuations, so the session keeps that generator to carry on from where
+# the last page left off.
+class CommentSession:
+    def __init__(self, videoId, sort):
+        self.videoId = videoId
+        self.sort = sort
+        self.lock = threading.Lock()
+        self.ydl = None
+        self.generator = None
+        self.exhausted = False
+        self.closed = False
+        self.roots = []    # root comments, in order
+        self.replies = {}  # parent ID -> replies, in order
+
+    # Starts yt_dlp's comment extraction without running it to completion.
+    # The session gets its own YoutubeDL because the generator keeps using it
+    # after extract_info returns.
+    def start(self):
+        if recording != None and recording.replaying:
+            self.ydl = None
+            self.generator = recording.stream('comments', [self.videoId, self.sort], None)
+            return
+        opts = dict(ydlProfiles['comments'])
+        opts['extractor_args'] = {
+            'youtube': {
+                'comment_sort': [self.sort],
+                'player_skip': ['js', 'webpage', 'configs']
+            }
+        }
+        self.ydl = yt_dlp.YoutubeDL(opts)
+        try:
+            hook_comment_generator(self.ydl.get_info_extractor('Youtube'), lambda generator: setattr(self, 'generator', generator))
+            self.ydl.extract_info('https://youtube.com/watch?v=' + self.videoId, download=False, ie_key='Youtube', process=False)
+            # the extractor always asks for comments, so if the hook wasn't
+            # called, yt_dlp gets them some other way now
+            if self.generator == None:
+                raise Error500('yt_dlp did not start extracting comments')
+        except Exception:
+            self.finish()
+            raise
+        if recording != None:
+            self.generator = recording.stream('comments', [self.videoId, self.sort], self.generator)
+
+    def finish(self):
+        self.exhausted = True
+        if self.ydl != None:
+            self.ydl.close()
+            self.ydl = None
+
+    # Called when the session is dropped from the cache. If a request is using
+    # it, the request closes it when it is done instead.
+    def close(self):
+        self.closed = True
+        if self.lock.acquire(blocking=False):
+            try:
+                self.finish()
+            finally:
+                self.lock.release()
+
+    # Fetches comments until there are more than count root comments (so that the
+    # replies to the first count are complete), or there are no more comments.
+    # Returns the root comments from start onwards and the replies index.
+    def get(self, start, count):
+        with self.lock, timed('upstream_ytdlp'):
+            try:
+                if self.generator == None and not self.exhausted:
+                    self.start()
+                while not self.exhausted and len(self.roots) <= count:
+                    try:
+                        comment = next(self.generator)
+                    except (StopIteration, yt_dlp.extractor.common.InfoExtractor.CommentsDisabled):
+                        self.finish()
+                        break
+                    if comment['parent'] == 'root':
+                        self.roots.append(comment)
+                    else:
+                        self.replies.setdefault(comment['parent'], []).append(comment)
+                return (self.roots[start:], self.replies)
+            finally:
+                if self.closed:
+                    self.finish()
+
+def get_comment_session(videoId, sort):
+    with commentSessionsLock:
+        session = commentSessions.get((videoId, sort))
+        if session == None:
+            session = CommentSession(videoId, sort)
+        # put it back to extend its lifetime
+        commentSessions.put((videoId, sort), session, commentSessionTTL)
+    return session
 
 def serve_comments_page(handler, params):
     if 'v' not in params:
         raise Error404
+    serve_streamed_page(handler, 'comments', lambda out: make_comments_page(out, params), 'Comments', includeHeaderBar=False)
+
+def make_comments_page(out, params):
     videoId = params['v'][0]
     sort    = params['sort'][0] if 'sort' in params else None
     (pageNum, minComment, maxComment) = page_min_max(params, 10)
     print('page: %i, mincomm: %i, maxcomm: %i' % (pageNum, minComment, maxComment))
     if sort not in {'top', 'new'}:
         sort = 'top'
-    url = 'https://youtube.com/watch?v=' + videoId
-    opts = {
-        'getcomments': True,
-        'extractor_args': {
-            'youtube': {
-                'max_comments': ['all',str(maxComment+1)],  # try to fetch an extra one so we can know if we are at the end of the list
-                'comment_sort': [sort],
-                'player_skip': ['js', 'webpage', 'configs']
-            }
-        }
-    }
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-    # get root comments and attach their replies
-    rootComments = [c for c in info['comments'] if c['parent'] == 'root'][minComment-1:]
-    for comment in rootComments:
-        comment['replies'] = [c for c in info['comments'] if c['parent'] == comment['id']]
+    session = get_comment_session(videoId, sort)
+    try:
+        (rootComments, replies) = session.get(minComment - 1, maxComment)
+    except Exception:
+        # the generator can't be resumed after an error, so start again next time
+        commentSessions.remove((videoId, sort))
+        raise
     thisUrl = '?v=' + videoId
     # sorter
     content = '<div>Sort By: '
@@ -736,73 +1866,1041 @@ def serve_comments_page(handler, params):
     content += ' '
     content += '<b>New</b>' if sort == 'new' else '<a href="%s">New</a>' % esc(thisUrl + '&sort=new')
     content += '</div>'
+    out.append(content)
     # nav bar
     thisUrl += '&sort=' + sort
     actualMax = minComment + min(len(rootComments), 10) - 1
     prevUrl = thisUrl + '&page=' + str(pageNum - 1) if pageNum > 1 else None
     nextUrl = thisUrl + '&page=' + str(pageNum + 1) if len(rootComments) > 10 else None
-    content += nav_buttons('Comments %i to %i' % (minComment, actualMax), prevUrl, nextUrl)
+    out.append(nav_buttons('Comments %i to %i' % (minComment, actualMax), prevUrl, nextUrl))
     # display comments
-    content += ''.join([render_comment(c) for c in rootComments[:10]])
-    serve_page(handler, 200, make_page('Comments', content, includeHeaderBar=False))
+    with timed('render'):
+        for c in rootComments[:10]:
+            out.append(render_comment(c, replies))
 
-##### Flash Converter #####
+##### Captions #####
+
+# Caption tracks are cached for this long (in seconds)
+captionCacheTTL = 60 * 60
+# Maximum total size of cached caption tracks, and of any single track, in bytes
+captionCacheMaxBytes = 16 * 1024 * 1024
+captionMaxBytes = 1024 * 1024
+
+captionCache = LRUCache(captionCacheMaxBytes)
 
-def serve_flv(handler, url):
-    # get duration
-    cmd = ['ffprobe', url]
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if result.returncode != 0:
+# Forwards caption requests to YouTube. (These can't be cross-origin for some reason)
+def serve_captions(handler, params):
+    # The remaining params are signatures which don't affect the content
+    key = tuple(params.get(p, [None])[0] for p in ('v', 'lang', 'tlang', 'kind', 'name', 'fmt'))
+    cached = captionCache.get(key)
+    if cached != None:
+        (contentType, body) = cached
+        handler.send_response(200)
+        handler.send_header('Content-Type', contentType)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+        return
+    forward_request(handler, 'youtube.com', '/api/timedtext', params, captionCache, key, captionCacheTTL, captionMaxBytes)
+
+##### Thumbnails #####
+
+# Thumbnails are fetched from these hosts and cached, so that clients get them
+# from us over the same connection as the page instead of connecting to YouTube
+thumbHosts = ('i.ytimg.com', 'yt3.ggpht.com', 'yt3.googleusercontent.com')
+thumbCacheDir = './thumbcache'
+thumbCacheMaxBytes = 512 * 1024 * 1024
+# Set to True to link to small re-encoded versions of thumbnails, for slow devices
+smallThumbnails = False
+# Width and JPEG quality (2-31, lower is better) of the small versions
+thumbSmallWidth = 160
+thumbSmallQuality = 6
+thumbMaxAge = 7 * 24 * 60 * 60
+
+thumbCacheBytes = 0  # protected by thumbCacheLock
+thumbCacheLock = threading.Lock()
+# Fetches and conversions currently running, by filename
+thumbFetches = SingleFlight()
+
+def init_thumb_cache():
+    global thumbCacheBytes
+    os.makedirs(thumbCacheDir, exist_ok=True)
+    for filename in os.listdir(thumbCacheDir):
+        path = os.path.join(thumbCacheDir, filename)
+        if filename.endswith('.part'):
+            os.remove(path)
+        else:
+            thumbCacheBytes += os.path.getsize(path)
+
+# Adds a file to the cache, and deletes the least recently fetched thumbnails
+# if the cache has grown too large
+def add_to_thumb_cache(partPath, path):
+    global thumbCacheBytes
+    os.replace(partPath, path)
+    with thumbCacheLock:
+        thumbCacheBytes += os.path.getsize(path)
+        if thumbCacheBytes <= thumbCacheMaxBytes:
+            return
+        files = []
+        for filename in os.listdir(thumbCacheDir):
+            if not filename.endswith('.part'):
+                stat = os.stat(os.path.join(thumbCacheDir, filename))
+                files.append((stat.st_mtime, stat.st_size, filename))
+        # clear out a bit more than needed, so that this doesn't happen on every fetch
+        thumbCacheBytes = sum(f[1] for f in files)
+        for (mtime, size, filename) in sorted(files):
+            if thumbCacheBytes <= thumbCacheMaxBytes * 0.9:
+                break
+            os.remove(os.path.join(thumbCacheDir, filename))
+            thumbCacheBytes -= size
+
+# Returns the URL to use for a thumbnail hosted on YouTube. Thumbnails on
+# other hosts are left alone.
+def proxy_thumbnail(url, small=None):
+    if url == None:
+        return None
+    if url.startswith('//'):
+        url = 'https:' + url
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.hostname not in thumbHosts:
+        return url
+    small = smallThumbnails if small == None else small
+    # The query is left out, since thumbnails don't need it (and it stops them from
+    # showing up on Webkit for some reason)
+    return '/thumb/%s%s%s' % ('small/' if small else '', parsed.hostname, parsed.path)
+
+# Guesses the type of an image from its first few bytes
+def image_type(data):
+    if data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data.startswith(b'GIF8'):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+def fetch_thumbnail(host, path, filename):
+    r = http_get('https://' + host + path)
+    if r.status_code == 404:
         raise Error404
-    m = re.search(r'Duration: ([^,]*),', str(result.stderr))
-    if m == None:
+    elif r.status_code != 200:
         raise Error500
-    duration = m.group(1)
-    cmd = ['ffmpeg', '-hide_banner', '-nostats', '-i', url, '-f', 'flv', '-ar', '44100', '-t', duration, 'pipe:1']
-    # actual size of the video is not known, so we must send it in chunks
-    handler.protocol_version = 'HTTP/1.1'
-    handler.send_response(200)
-    handler.send_header('Transfer-Encoding', 'chunked')
+    (fd, partPath) = tempfile.mkstemp(suffix='.part', dir=thumbCacheDir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(r.content)
+    add_to_thumb_cache(partPath, os.path.join(thumbCacheDir, filename))
+
+# Makes the small version of a cached thumbnail. If ffmpeg can't do it, the
+# small version is just a copy of the original.
+def make_small_thumbnail(fullPath, filename):
+    (fd, partPath) = tempfile.mkstemp(suffix='.part', dir=thumbCacheDir)
+    os.close(fd)
+    cmd = ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error', '-y', '-i', fullPath,
+        '-vf', 'scale=min(iw\\,%i):-2' % thumbSmallWidth, '-q:v', str(thumbSmallQuality),
+        '-frames:v', '1', '-f', 'mjpeg', partPath]
+    result = subprocess.run(cmd, stdin=subprocess.DEVNULL)
+    if result.returncode != 0 or os.path.getsize(partPath) == 0:
+        with open(fullPath, 'rb') as src, open(partPath, 'wb') as dst:
+            dst.write(src.read())
+    add_to_thumb_cache(partPath, os.path.join(thumbCacheDir, filename))
+
+# Returns the path of a thumbnail in the cache, fetching or converting it first if needed
+def get_thumbnail(host, path, small):
+    name = hashlib.sha1((host + path).encode(encoding='utf-8')).hexdigest()
+    fullPath = os.path.join(thumbCacheDir, name)
+    if not os.path.exists(fullPath):
+        thumbFetches.do(name, lambda: fetch_thumbnail(host, path, name))
+    if not small:
+        return fullPath
+    smallPath = fullPath + '-small'
+    if not os.path.exists(smallPath):
+        thumbFetches.do(name + '-small', lambda: make_small_thumbnail(fullPath, name + '-small'))
+    return smallPath
+
+# Serves /thumb/[small/]<host>/<path>
+def serve_thumbnail(handler, path):
+    parts = path.split('/', 3)  # '', 'thumb', host or 'small', rest
+    small = len(parts) == 4 and parts[2] == 'small'
+    if small:
+        parts = ['', ''] + parts[3].split('/', 1)
+    if len(parts) < 4 or parts[2] not in thumbHosts or '..' in parts[3].split('/'):
+        raise Error404
+    (host, rest) = (parts[2], '/' + parts[3])
+    filePath = get_thumbnail(host, rest, small)
+    try:
+        with open(filePath, 'rb') as f:
+            content = f.read()
+    except FileNotFoundError:
+        # evicted in the meantime
+        raise Error503
+    # the content of a thumbnail never changes, so its ETag can come from its name
+    etag = '"%s"' % os.path.basename(filePath)
+    send_content(handler, 200, image_type(content), content, etag, None, 'public, max-age=%i' % thumbMaxAge)
+
+##### Flash Converter #####
+
+# Directory where converted videos are kept, and the maximum total size of the files in it
+flvCacheDir = './flvcache'
+flvCacheMaxBytes = 4 * 1024 * 1024 * 1024
+# Size of the chunks that converted video is read and sent in
+flvChunkSize = 32 * 1024
+# Converted videos have a keyframe at least this often (in seconds), which is
+# how precisely a cached video can be seeked
+flvKeyframeInterval = 2
+# The Flash player seeks by adding a keyframe's file position from the video's
+# metadata to its URL. While a video is still being converted, the positions
+# aren't known, so the metadata lists a keyframe every flvKeyframeInterval
+# seconds with this plus its time in milliseconds as its "position". No FLV
+# file is ever this big, so these can be told apart from real positions.
+flvTimeSeekBase = 10**12
+
+# Removes conversions left unfinished by a previous run
+def init_flv_cache():
+    os.makedirs(flvCacheDir, exist_ok=True)
+    for filename in os.listdir(flvCacheDir):
+        if filename.endswith('.part'):
+            os.remove(os.path.join(flvCacheDir, filename))
+
+# Deletes the least recently watched videos until the cache fits in flvCacheMaxBytes
+def evict_flv_cache():
+    files = []
+    for filename in os.listdir(flvCacheDir):
+        if filename.endswith('.flv'):
+            stat = os.stat(os.path.join(flvCacheDir, filename))
+            files.append((stat.st_mtime, stat.st_size, filename))
+    total = sum(f[1] for f in files)
+    for (mtime, size, filename) in sorted(files):
+        if total <= flvCacheMaxBytes:
+            break
+        # anyone still streaming it has it open, so it can be deleted right away
+        os.remove(os.path.join(flvCacheDir, filename))
+        total -= size
+
+# Gets the URL of a video's stream in the given format
+def get_stream_url(videoId, formatId):
+    try:
+        info = extract_info('watch', 'https://m.youtube.com/watch?app=m&v=' + videoId, 'watch')
+    except yt_dlp.utils.DownloadError:
+        raise Error404
+    for fmt in info['formats']:
+        if fmt['format_id'] == formatId:
+            return fmt['url']
+    raise Error404
+
+# Maximum number of ffmpeg processes, and of conversions waiting for one
+flvMaxTranscodes = max(1, (os.cpu_count() or 2) // 2)
+flvMaxQueued = 4
+
+# Limits how many conversions run at once. Conversions over the limit wait in
+# a queue, and once that is full, requests for new conversions are refused.
+class TranscodeScheduler:
+    def __init__(self, maxRunning, maxQueued):
+        self.maxRunning = maxRunning
+        self.maxQueued = maxQueued
+        self.running = 0
+        self.queued = 0
+        self.cond = threading.Condition()
+
+    # Reserves a place in the queue, raising Error503 if there is none
+    def admit(self):
+        with self.cond:
+            if self.running + self.queued >= self.maxRunning + self.maxQueued:
+                raise Error503('too many conversions')
+            self.queued += 1
+
+    # Waits for a queued conversion's turn to run. Returns False if it was
+    # cancelled while waiting.
+    def wait(self, transcode):
+        with self.cond:
+            while self.running >= self.maxRunning and not transcode.cancelled:
+                self.cond.wait(1)
+            self.queued -= 1
+            if transcode.cancelled:
+                self.cond.notify_all()
+                return False
+            self.running += 1
+            return True
+
+    def release(self):
+        with self.cond:
+            self.running -= 1
+            self.cond.notify_all()
+
+flvScheduler = TranscodeScheduler(flvMaxTranscodes, flvMaxQueued)
+
+# Conversions in progress, by cache filename
+transcodes = {}
+transcodesLock = threading.Lock()
+
+# An ffmpeg conversion to FLV. The output is written to a .part file in the
+# cache, which is renamed once it is complete. Everyone watching the video
+# while it is being converted reads the .part file as it grows, so that there
+# is only one ffmpeg process per video no matter how many people watch it.
+# When the last viewer goes away, ffmpeg is killed.
+# A conversion that starts at an offset (in seconds) into the video is for
+# seeking, and is thrown away instead of being cached.
+class Transcode:
+    def __init__(self, filename, url, offset=0):
+        self.filename = filename
+        self.url = url
+        self.offset = offset
+        self.path = os.path.join(flvCacheDir, filename)
+        self.partPath = None
+        self.cond = threading.Condition()
+        self.proc = None
+        self.running = False   # holds one of the scheduler's slots
+        self.started = False
+        self.cancelled = False
+        self.complete = False  # ffmpeg has finished writing the .part file
+        self.done = False
+        self.error = None
+        self.duration = None
+        self.size = 0     # number of bytes written to the .part file so far
+        self.viewers = 0  # protected by transcodesLock
+
+    def run(self):
+        if not flvScheduler.wait(self):
+            self.finish(False, Error503('cancelled'))
+            return
+        self.running = True
+        try:
+            out = self.start()
+        except Exception as e:
+            self.finish(False, e)
+            return
+        self.pump(out)
+
+    def start(self):
+        # get duration
+        cmd = ['ffprobe', self.url]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise Error404
+        m = re.search(r'Duration: (\d+):(\d+):([\d.]+),', str(result.stderr))
+        if m == None:
+            raise Error500
+        duration = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+        self.duration = duration
+        cmd = ['ffmpeg', '-hide_banner', '-nostats']
+        if self.offset > 0:
+            # seeking before -i skips the input without decoding it
+            cmd += ['-ss', str(self.offset)]
+        cmd += ['-i', self.url]
+        if self.offset > 0:
+            # Timestamps carry on from the offset, and there is no metadata, so
+            # the player keeps the duration and keyframe index of the whole video
+            cmd += ['-output_ts_offset', str(self.offset), '-flvflags', 'no_metadata']
+        cmd += [
+            '-f', 'flv', '-ar', '44100',
+            '-force_key_frames', 'expr:gte(t,n_forced*%i)' % flvKeyframeInterval,
+            '-t', '%.3f' % max(0, duration - self.offset),
+            'pipe:1']
+        (fd, self.partPath) = tempfile.mkstemp(suffix='.part', prefix=self.filename + '.', dir=flvCacheDir)
+        out = os.fdopen(fd, 'wb', buffering=0)
+        with self.cond:
+            if self.cancelled:
+                out.close()
+                raise Error503('cancelled')
+            print('encoding video ' + self.filename, flush=True)
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, bufsize=0)
+            self.started = True
+            self.cond.notify_all()
+        return out
+
+    # Copies ffmpeg's output to the .part file
+    def pump(self, out):
+        buffer = memoryview(bytearray(flvChunkSize))
+        with out as f:
+            while True:
+                n = self.proc.stdout.readinto(buffer)
+                if not n:
+                    break
+                # the file is unbuffered, so viewers can read it as soon as it is written
+                written = 0
+                while written < n:
+                    written += f.write(buffer[written:n])
+                with self.cond:
+                    self.size += n
+                    self.cond.notify_all()
+        self.proc.stdout.close()
+        self.proc.wait()
+        print('done encoding ' + self.filename, flush=True)
+        with self.cond:
+            success = self.proc.returncode == 0 and not self.cancelled
+            self.complete = True
+            self.cond.notify_all()
+        if not success:
+            self.finish(False, Error500('ffmpeg failed'))
+        elif self.offset > 0:
+            self.finish(False)
+        else:
+            self.finish(True, path=self.add_keyframe_index())
+
+    # Makes a copy of the .part file with an index of keyframe times and positions
+    # in its metadata, which players use to seek. (ffmpeg can only write this to a
+    # file, not a pipe.) The video is copied rather than converted again. Viewers
+    # still reading the .part file are not affected. Returns the path of the copy,
+    # or of the .part file if it could not be made.
+    def add_keyframe_index(self):
+        (fd, indexedPath) = tempfile.mkstemp(suffix='.part', prefix=self.filename + '.', dir=flvCacheDir)
+        os.close(fd)
+        cmd = ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error', '-y', '-i', self.partPath,
+            '-c', 'copy', '-f', 'flv', '-flvflags', 'add_keyframe_index', indexedPath]
+        if subprocess.run(cmd, stdin=subprocess.DEVNULL).returncode != 0:
+            os.remove(indexedPath)
+            return self.partPath
+        return indexedPath
+
+    # Ends the conversion. If it succeeded, the file at path (the .part file by
+    # default) is moved into the cache.
+    def finish(self, success, error=None, path=None):
+        if self.running:
+            flvScheduler.release()
+        with self.cond:
+            if success:
+                os.replace(path or self.partPath, self.path)
+            if self.partPath != None and os.path.exists(self.partPath):
+                os.remove(self.partPath)
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+        with transcodesLock:
+            if transcodes.get(self.filename) is self:
+                del transcodes[self.filename]
+        if success:
+            evict_flv_cache()
+
+    # Stops the conversion, killing ffmpeg if it has started
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+            if self.proc != None:
+                self.proc.kill()
+
+    # Must be called with transcodesLock held
+    def join(self):
+        self.viewers += 1
+
+    def leave(self):
+        with transcodesLock:
+            self.viewers -= 1
+            cancel = self.viewers == 0 and not self.complete
+            # new viewers will have to start again from scratch
+            if cancel and transcodes.get(self.filename) is self:
+                del transcodes[self.filename]
+        if cancel:
+            print('cancelling conversion of ' + self.filename, flush=True)
+            self.cancel()
+
+    # Waits on the condition until ready() is true. Returns False if the client
+    # disconnects in the meantime.
+    def wait_until(self, handler, ready):
+        while not ready():
+            self.cond.wait(1)
+            if not ready() and handler.client_gone():
+                return False
+        return True
+
+    # Opens the .part file for reading, once ffmpeg has started. Returns None if
+    # the conversion has already finished, in which case the complete file
+    # should be used instead.
+    def open(self, handler):
+        with self.cond:
+            if not self.wait_until(handler, lambda: self.started or self.done):
+                raise ConnectionAbortedError
+            if self.done:
+                if self.error != None:
+                    raise self.error
+                return None
+            return open(self.partPath, 'rb', buffering=0)
+
+    # Waits until the .part file has at least size bytes, or is complete.
+    # Returns False if the client disconnects in the meantime.
+    def wait_for_size(self, handler, size):
+        with self.cond:
+            return self.wait_until(handler, lambda: self.size >= size or self.complete or self.done)
+
+    # Reads the FLV header and ffmpeg's onMetaData tag from the start of the .part
+    # file, and returns them with the duration and a keyframe index that the
+    # player can seek with (see flvTimeSeekBase) added to the metadata, along
+    # with the file position after the tag. ffmpeg can't fill these in when
+    # writing to a pipe. Returns None if the file doesn't start that way.
+    def read_metadata(self, handler, f):
+        if not self.wait_for_size(handler, 13 + 11):
+            raise ConnectionAbortedError
+        header = f.read(13)
+        tagHeader = f.read(11)
+        if header[:3] != b'FLV' or len(tagHeader) < 11 or tagHeader[0] != 18:
+            return None
+        dataSize = int.from_bytes(tagHeader[1:4], 'big')
+        if not self.wait_for_size(handler, 13 + 11 + dataSize + 4):
+            raise ConnectionAbortedError
+        data = f.read(dataSize)
+        try:
+            (name, pos) = amf0_read(data, 0)
+            (meta, pos) = amf0_read(data, pos)
+        except (ValueError, IndexError, struct.error):
+            return None
+        if name != 'onMetaData' or type(meta) is not dict or self.duration == None:
+            return None
+        times = [i * flvKeyframeInterval for i in range(int(self.duration // flvKeyframeInterval) + 1) if i * flvKeyframeInterval < self.duration]
+        meta['duration'] = self.duration
+        meta['keyframes'] = {
+            'times':         times,
+            'filepositions': [flvTimeSeekBase + round(t * 1000) for t in times],
+        }
+        return (header + make_flv_script_tag(amf0_write('onMetaData') + amf0_write(meta)), 13 + 11 + dataSize + 4)
+
+    # Sends the video to the client as it is converted
+    def stream(self, handler, f):
+        prefix = self.read_metadata(handler, f) if self.offset == 0 else None
+        # actual size of the video is not known, so we must send it in chunks
+        handler.send_response(200)
+        handler.send_header('Transfer-Encoding', 'chunked')
+        handler.send_header('Content-Type', 'video/x-flv')
+        handler.end_headers()
+        handler.responseStarted = True
+        writer = ChunkedWriter(handler, bufferSize=flvChunkSize)
+        sent = 0
+        if prefix != None:
+            (data, sent) = prefix
+            writer.write(data)
+        f.seek(sent)
+        while True:
+            with self.cond:
+                if not self.wait_until(handler, lambda: self.size > sent or self.complete or self.done):
+                    return
+                (size, complete) = (self.size, self.complete or self.done)
+            sent += writer.copy_from(f, size - sent)
+            if complete:
+                break
+        writer.close()
+        writer.report(self.filename)
+
+# Parses a Range header of the form "bytes=start-end", and returns the range as
+# (start, end) with end inclusive, or None if the whole file should be sent
+def parse_range(handler, size):
+    m = re.fullmatch(r'bytes=(\d*)-(\d*)', handler.headers.get('Range') or '')
+    if m == None or m.group(1) == m.group(2) == '':
+        return None
+    if m.group(1) == '':  # the last n bytes
+        return (max(0, size - int(m.group(2))), size - 1)
+    end = int(m.group(2)) if m.group(2) != '' else size - 1
+    return (int(m.group(1)), min(end, size - 1))
+
+# Sends a completely converted video from the cache
+def serve_flv_file(handler, f):
+    size = os.fstat(f.fileno()).st_size
+    byteRange = parse_range(handler, size)
+    if byteRange != None and byteRange[0] > byteRange[1]:
+        handler.send_response(416)
+        handler.send_header('Content-Range', 'bytes */%i' % size)
+        handler.send_header('Content-Length', '0')
+        handler.end_headers()
+        return
+    if byteRange == None:
+        (start, end) = (0, size - 1)
+        handler.send_response(200)
+    else:
+        (start, end) = byteRange
+        handler.send_response(206)
+        handler.send_header('Content-Range', 'bytes %i-%i/%i' % (start, end, size))
     handler.send_header('Content-Type', 'video/x-flv')
+    handler.send_header('Content-Length', str(end - start + 1))
+    handler.send_header('Accept-Ranges', 'bytes')
     handler.end_headers()
-    print('encoding video', flush=True)
-    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
-    chunkSize = 32 * 1024
+    handler.responseStarted = True
+    f.seek(start)
+    writer = ChunkedWriter(handler, False, flvChunkSize)
+    writer.send_file(f, end - start + 1)
+    writer.report(os.path.basename(f.name))
+
+# Reads an AMF0 value (as used in FLV script tags) starting at pos in data, and
+# returns it along with the position after it. Only the types that ffmpeg
+# writes are supported.
+def amf0_read(data, pos):
+    kind = data[pos]
+    pos += 1
+    if kind == 0:  # number
+        return (struct.unpack_from('>d', data, pos)[0], pos + 8)
+    elif kind == 1:  # boolean
+        return (data[pos] != 0, pos + 1)
+    elif kind == 2:  # string
+        length = struct.unpack_from('>H', data, pos)[0]
+        return (data[pos+2:pos+2+length].decode('utf-8'), pos + 2 + length)
+    elif kind == 3 or kind == 8:  # object, or ECMA array (which starts with a count)
+        if kind == 8:
+            pos += 4
+        obj = {}
+        while True:
+            length = struct.unpack_from('>H', data, pos)[0]
+            pos += 2
+            if length == 0 and data[pos] == 9:  # object end marker
+                return (obj, pos + 1)
+            key = data[pos:pos+length].decode('utf-8')
+            (obj[key], pos) = amf0_read(data, pos + length)
+    elif kind == 5 or kind == 6:  # null, undefined
+        return (None, pos)
+    elif kind == 10:  # strict array
+        count = struct.unpack_from('>I', data, pos)[0]
+        pos += 4
+        items = []
+        for i in range(count):
+            (item, pos) = amf0_read(data, pos)
+            items.append(item)
+        return (items, pos)
+    raise ValueError('unsupported AMF0 type %i' % kind)
+
+def amf0_write(value):
+    if value == None:
+        return b'\x05'
+    elif type(value) is bool:
+        return b'\x01' + bytes([value])
+    elif type(value) in (int, float):
+        return b'\x00' + struct.pack('>d', value)
+    elif type(value) is str:
+        data = value.encode(encoding='utf-8')
+        return b'\x02' + struct.pack('>H', len(data)) + data
+    elif type(value) is list:
+        return b'\x0a' + struct.pack('>I', len(value)) + b''.join(amf0_write(item) for item in value)
+    elif type(value) is dict:
+        parts = [b'\x08', struct.pack('>I', len(value))]
+        for (key, item) in value.items():
+            data = key.encode(encoding='utf-8')
+            parts += [struct.pack('>H', len(data)), data, amf0_write(item)]
+        parts.append(b'\0\0\x09')
+        return b''.join(parts)
+    raise ValueError('cannot write %r as AMF0' % value)
+
+# Returns a script tag (with timestamp 0) containing data, followed by its PreviousTagSize
+def make_flv_script_tag(data):
+    return b'\x12' + len(data).to_bytes(3, 'big') + b'\0\0\0\0\0\0\0' + data + (11 + len(data)).to_bytes(4, 'big')
+
+# Returns the times (in seconds) and file positions of the video keyframes in an FLV file
+def scan_flv_keyframes(f):
+    times = []
+    positions = []
+    f.seek(0)
+    header = f.read(9)
+    if header[:3] != b'FLV':
+        raise Error500('not an FLV file')
+    pos = struct.unpack('>I', header[5:9])[0] + 4  # skip the first PreviousTagSize
     while True:
-        chunk = proc.stdout.read(chunkSize)
-        length = len(chunk)
-        output = bytes('%X\r\n' % length, 'ascii')
-        output += chunk
-        output += bytes('\r\n', 'ascii')
-        handler.wfile.write(output)
-        if length == 0:
+        f.seek(pos)
+        tag = f.read(12)
+        if len(tag) < 12:
             break
-    print('done encoding', flush=True)
+        tagType = tag[0] & 0x1F
+        dataSize = int.from_bytes(tag[1:4], 'big')
+        timestamp = int.from_bytes(tag[4:7], 'big') | (tag[7] << 24)
+        # the high nibble of the first byte of a video tag is the frame type, 1 being a keyframe
+        if tagType == 9 and tag[11] >> 4 == 1:
+            times.append(timestamp / 1000)
+            positions.append(pos)
+        pos += 11 + dataSize + 4
+    return (times, positions)
+
+# Keyframe indexes of cached videos, as (inode, times, positions) by filename.
+# They are kept after a video is evicted, so that players which still have its
+# index can seek in it.
+flvIndexCache = LRUCache(256)
+
+def get_flv_keyframe_index(f):
+    stat = os.fstat(f.fileno())
+    filename = os.path.basename(f.name)
+    index = flvIndexCache.get(filename)
+    if index == None or index[0] != stat.st_ino:
+        index = (stat.st_ino,) + scan_flv_keyframes(f)
+        flvIndexCache.put(filename, index, 24 * 60 * 60)
+    return index
+
+# Sends a cached video starting from the last keyframe at or before the byte
+# position start, or if offset is given, the time offset in seconds. The FLV
+# header is sent first, followed by the tags from the keyframe onwards, so the
+# player keeps the metadata it already has.
+def serve_flv_file_from(handler, f, start, offset=None):
+    stat = os.fstat(f.fileno())
+    (_, times, positions) = get_flv_keyframe_index(f)
+    if offset != None:
+        i = bisect.bisect_right(times, offset) - 1
+    else:
+        i = bisect.bisect_right(positions, start) - 1
+    if i < 0:
+        serve_flv_file(handler, f)
+        return
+    f.seek(0)
+    header = f.read(9)
+    header += b'\0\0\0\0'  # PreviousTagSize0
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'video/x-flv')
+    handler.send_header('Content-Length', str(len(header) + stat.st_size - positions[i]))
+    handler.end_headers()
+    handler.responseStarted = True
+    writer = ChunkedWriter(handler, False, flvChunkSize)
+    writer.write(header)
+    f.seek(positions[i])
+    writer.send_file(f, stat.st_size - positions[i])
+    writer.report(os.path.basename(f.name))
+
+# Sends a video, converting it if it isn't cached. start is the position that
+# the player seeks to: either a byte position in the cached file, or a time
+# from the keyframe index sent while it was being converted (flvTimeSeekBase).
+def serve_flv(handler, videoId, formatId, start=0):
+    if not re.fullmatch(r'[A-Za-z0-9_-]+', videoId) or not formatId.isdigit():
+        raise Error404
+    filename = '%s-%s.flv' % (videoId, formatId)
+    path = os.path.join(flvCacheDir, filename)
+    if start >= flvTimeSeekBase:
+        offset = (start - flvTimeSeekBase) / 1000
+        if offset > 0:
+            serve_flv_seek(handler, videoId, formatId, filename, None, offset)
+            return
+    elif start > 0:
+        serve_flv_seek(handler, videoId, formatId, filename, start)
+        return
+    while True:
+        with transcodesLock:
+            transcode = transcodes.get(filename)
+            if transcode != None:
+                transcode.join()
+        if transcode == None:
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                pass
+            else:
+                with f:
+                    os.utime(path)  # mark it as recently watched
+                    serve_flv_file(handler, f)
+                return
+            url = get_stream_url(videoId, formatId)
+            with transcodesLock:
+                transcode = transcodes.get(filename)
+                if transcode == None and not os.path.exists(path):
+                    flvScheduler.admit()
+                    transcode = Transcode(filename, url)
+                    transcodes[filename] = transcode
+                    threading.Thread(target=transcode.run, daemon=True).start()
+                if transcode != None:
+                    transcode.join()
+            if transcode == None:
+                continue  # it finished in the meantime
+        if watch_transcode(handler, transcode):
+            return
+
+# Streams a conversion that the viewer has joined, and then leaves it. Returns
+# False if the conversion finished before it could be watched.
+def watch_transcode(handler, transcode):
+    try:
+        f = transcode.open(handler)
+        if f == None:
+            return False
+        with f:
+            transcode.stream(handler, f)
+    except (ConnectionAbortedError, BrokenPipeError, ConnectionResetError):
+        handler.close_connection = True
+    finally:
+        transcode.leave()
+    return True
+
+# Sends the video from the byte position start in the cached file, or from
+# offset seconds in. If the file isn't cached, the video is converted again
+# from that time, which for a byte position is found from the keyframe index
+# the file had, if that is still known.
+def serve_flv_seek(handler, videoId, formatId, filename, start, offset=None):
+    try:
+        f = open(os.path.join(flvCacheDir, filename), 'rb')
+    except FileNotFoundError:
+        pass
+    else:
+        with f:
+            serve_flv_file_from(handler, f, start, offset)
+        return
+    if offset == None:
+        index = flvIndexCache.get(filename)
+        if index == None:
+            raise Error404('no keyframe index for %s to seek to byte %i with' % (filename, start))
+        (_, times, positions) = index
+        offset = times[max(0, bisect.bisect_right(positions, start) - 1)]
+    url = get_stream_url(videoId, formatId)
+    flvScheduler.admit()
+    transcode = Transcode(filename, url, offset)
+    with transcodesLock:
+        transcode.join()
+    threading.Thread(target=transcode.run, daemon=True).start()
+    if not watch_transcode(handler, transcode):
+        raise Error500('conversion finished before it could be watched')
+
+##### Metrics #####
+
+# Upper bounds of the histogram buckets, in seconds
+metricsBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def format_labels(names, values):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for (name, value) in zip(names, values))
+
+# A Prometheus histogram, with a series for each combination of label values
+class Histogram:
+    def __init__(self, name, help, labelNames, buckets=metricsBuckets):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.buckets = buckets
+        self.series = {}  # label values -> [count in each bucket..., count above them all, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series == None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def render(self, out):
+        out.append('# HELP %s %s' % (self.name, self.help))
+        out.append('# TYPE %s histogram' % self.name)
+        with self.lock:
+            allSeries = sorted((labels, list(series)) for (labels, series) in self.series.items())
+        for (labels, series) in allSeries:
+            count = 0
+            for (le, n) in zip(self.buckets + ('+Inf',), series):
+                count += n
+                out.append('%s_bucket{%s} %i' % (self.name, format_labels(self.labelNames + ('le',), labels + (le,)), count))
+            out.append('%s_sum{%s} %f' % (self.name, format_labels(self.labelNames, labels), series[-1]))
+            out.append('%s_count{%s} %i' % (self.name, format_labels(self.labelNames, labels), count))
+
+requestSeconds = Histogram('tubescraper_request_duration_seconds', 'Time taken to handle requests, by route.', ('route',))
+phaseSeconds = Histogram('tubescraper_phase_duration_seconds',
+    'Time spent fetching from YouTube, parsing, rendering and writing to sockets.', ('phase',))
+# Number of requests handled, by route and status, and the number being handled
+requestCounts = collections.Counter()
+requestCountsLock = threading.Lock()
+requestsInProgress = 0
+
+# Times the code inside a with statement as one of the phases
+@contextlib.contextmanager
+def timed(phase):
+    startTime = time.monotonic()
+    try:
+        yield
+    finally:
+        phaseSeconds.observe((phase,), time.monotonic() - startTime)
+
+# Caches whose hit ratios are reported
+metricsCaches = {
+    'info':           infoCache,
+    'page':           pageCache,
+    'channel_tab':    channelTabCursors,
+    'playlist_index': playlistIndexCache,
+    'comments':       commentSessions,
+    'captions':       captionCache,
+    'flv_index':      flvIndexCache,
+}
+metricsSingleFlights = {
+    'info':  infoFetches,
+    'page':  pageFetches,
+    'thumb': thumbFetches,
+}
+
+# Writes a single metric with one sample per label value
+def render_metric(out, name, type, help, labelName, samples):
+    out.append('# HELP %s %s' % (name, help))
+    out.append('# TYPE %s %s' % (name, type))
+    for (label, value) in samples:
+        if labelName == None:
+            out.append('%s %s' % (name, value))
+        else:
+            out.append('%s{%s} %s' % (name, format_labels((labelName,), (label,)), value))
+
+def serve_metrics(handler):
+    out = []
+    with requestCountsLock:
+        counts = sorted(requestCounts.items())
+    out.append('# HELP tubescraper_requests_total Requests handled, by route and status.')
+    out.append('# TYPE tubescraper_requests_total counter')
+    for ((route, status), n) in counts:
+        out.append('tubescraper_requests_total{%s} %i' % (format_labels(('route', 'status'), (route, status)), n))
+    requestSeconds.render(out)
+    phaseSeconds.render(out)
+    render_metric(out, 'tubescraper_requests_in_progress', 'gauge', 'Requests being handled.', None, [(None, requestsInProgress)])
+    caches = sorted(metricsCaches.items())
+    render_metric(out, 'tubescraper_cache_hits_total', 'counter', 'Cache lookups that found an entry.', 'cache',
+        [(name, cache.hits) for (name, cache) in caches])
+    render_metric(out, 'tubescraper_cache_misses_total', 'counter', 'Cache lookups that found nothing.', 'cache',
+        [(name, cache.misses) for (name, cache) in caches])
+    render_metric(out, 'tubescraper_cache_hit_ratio', 'gauge', 'Fraction of cache lookups that found an entry.', 'cache',
+        [(name, '%f' % (cache.hits / (cache.hits + cache.misses) if cache.hits + cache.misses > 0 else 0)) for (name, cache) in caches])
+    render_metric(out, 'tubescraper_cache_entries', 'gauge', 'Entries in each cache.', 'cache',
+        [(name, len(cache)) for (name, cache) in caches])
+    render_metric(out, 'tubescraper_coalesced_fetches_total', 'counter', 'Fetches that shared the result of an identical one in flight.', 'fetch',
+        [(name, flight.coalesced) for (name, flight) in sorted(metricsSingleFlights.items())])
+    render_metric(out, 'tubescraper_threads', 'gauge', 'Threads that are alive.', None, [(None, threading.active_count())])
+    render_metric(out, 'tubescraper_ffmpeg_running', 'gauge', 'ffmpeg conversions running.', None, [(None, flvScheduler.running)])
+    render_metric(out, 'tubescraper_ffmpeg_queued', 'gauge', 'ffmpeg conversions waiting to start.', None, [(None, flvScheduler.queued)])
+    with unknownRenderersLock:
+        unknown = sorted(unknownRenderers.items())
+    render_metric(out, 'tubescraper_unknown_renderer_total', 'counter', 'Nodes seen without a renderer, by kind.', 'renderer', unknown)
+    content = ('\n'.join(out) + '\n').encode(encoding='utf-8')
+    send_content(handler, 200, 'text/plain; version=0.0.4', content, cacheControl='no-store')
+
+##### Profiler #####
+
+# Requests which carry this token, either in an X-Profile-Token header or a
+# profile= parameter, are run under cProfile. Profiling is off when it is None.
+profileToken = None
+profileDir = './profiles'
+# Number of functions listed in a profile summary by default
+profileSummaryLines = 40
+# Only one request is profiled at a time, since the profiler slows it down a
+# lot and newer versions of Python only allow one profiler to be active
+profileLock = threading.Lock()
+
+def check_profile_token(token):
+    return profileToken != None and token != None and hmac.compare_digest(token.encode(encoding='utf-8'), profileToken.encode(encoding='utf-8'))
+
+# Removes the profile token from the request, and returns the token
+def take_profile_token(handler):
+    token = handler.headers.get('X-Profile-Token')
+    arr = handler.path.split('?', 1)
+    if len(arr) > 1:
+        params = urllib.parse.parse_qsl(arr[1], keep_blank_values=True)
+        for (name, value) in params:
+            if name == 'profile':
+                token = value
+        params = [(name, value) for (name, value) in params if name != 'profile']
+        handler.path = arr[0] + ('?' + urllib.parse.urlencode(params) if len(params) > 0 else '')
+    return token
+
+# Runs a request handler function under the profiler if the request asks for
+# it, and saves the stats to the profile directory. The ID of the profile is
+# sent in an X-Profile-Id header with the response.
+def run_profiled(handler, func):
+    handler.profileId = None
+    if profileToken == None or not check_profile_token(take_profile_token(handler)):
+        return func()
+    if not profileLock.acquire(blocking=False):
+        print('not profiling %s: another request is being profiled' % handler.path)
+        return func()
+    try:
+        handler.profileId = '%s-%s' % (time.strftime('%Y%m%d-%H%M%S'), os.urandom(4).hex())
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return func()
+        finally:
+            profiler.disable()
+            filename = os.path.join(profileDir, handler.profileId + '.prof')
+            profiler.dump_stats(filename)
+            print('profiled %s: saved %s' % (handler.path, filename))
+    finally:
+        profileLock.release()
+
+# Serves a summary of a saved profile, with the functions that took the most
+# time. Parameters are id, n (the number of functions) and sort (any pstats
+# sort key, such as cumulative or tottime).
+def serve_profile(handler, params):
+    if not check_profile_token(handler.headers.get('X-Profile-Token') or params.get('token', [None])[0]):
+        raise Error404
+    profileId = params.get('id', [''])[0]
+    if re.fullmatch(r'[0-9]{8}-[0-9]{6}-[0-9a-f]{8}', profileId) == None:
+        raise Error404
+    try:
+        count = int(params['n'][0]) if 'n' in params else profileSummaryLines
+        sort = params['sort'][0] if 'sort' in params else 'cumulative'
+        out = io.StringIO()
+        stats = pstats.Stats(os.path.join(profileDir, profileId + '.prof'), stream=out)
+        stats.sort_stats(sort).print_stats(count)
+    except (OSError, ValueError, KeyError):
+        raise Error404
+    send_content(handler, 200, 'text/plain; charset=utf-8', out.getvalue().encode(encoding='utf-8'), cacheControl='no-store')
 
 ##### Request Handler #####
 
+# Cache-Control max-age for local files, in seconds
+staticMaxAge = 7 * 24 * 60 * 60
+
+# Local files loaded into memory at startup: path -> (content, gzipped content, ETag)
+staticFiles = {}
+
+def load_static_files():
+    for filename in allowedFiles:
+        try:
+            with open('./' + filename, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            continue
+        gzipped = gzip.compress(content, 9, mtime=0)
+        # don't bother with files that are already compressed
+        if len(gzipped) > len(content) * 0.9:
+            gzipped = None
+        staticFiles[filename] = (content, gzipped, make_etag(content))
+
 # Serves a local file
 def serve_file(handler, filename, contentType=None):
     print('serving file ' + filename)
-    try:
-        with open('./' + filename, 'rb') as f:
-            handler.send_response(200)
-            if contentType:
-                handler.send_header('Content-type', contentType)
-                handler.end_headers()
-            handler.wfile.write(f.read())
-    except FileNotFoundError:
+    if filename not in staticFiles:
         raise Error404
-    except:
-        raise Error500
-    return
+    (content, gzipped, etag) = staticFiles[filename]
+    send_content(
+        handler,
+        200,
+        contentType or 'application/octet-stream',
+        content,
+        etag,
+        gzipped,
+        'public, max-age=%i' % staticMaxAge)
 
-# Forwards a request to an external site and returns the result back to the client
-def forward_request(handler, domain, path, params):
+# Size of the chunks that forwarded responses are streamed in
+forwardChunkSize = 16 * 1024
+
+# Forwards a request to an external site and streams the result back to the client.
+# If a cache is given, successful responses up to maxCachedBytes long are stored in it.
+def forward_request(handler, domain, path, params, cache=None, cacheKey=None, ttl=0, maxCachedBytes=0):
     url = 'https://' + domain + path
-    r = requests.get(url, params)
-    handler.send_response(r.status_code)
-    handler.wfile.write(r.content)
+    # Ask for an uncompressed response so that its Content-Length can be passed on
+    with http_get(url, params, stream=True, headers={'Accept-Encoding': 'identity'}) as r:
+        contentType = r.headers.get('Content-Type', 'application/octet-stream')
+        length = r.headers.get('Content-Length')
+        handler.send_response(r.status_code)
+        handler.send_header('Content-Type', contentType)
+        # in case the server compressed it anyway
+        encoding = r.headers.get('Content-Encoding')
+        if encoding != None:
+            handler.send_header('Content-Encoding', encoding)
+        if length != None:
+            handler.send_header('Content-Length', length)
+        else:
+            # the end of the body is marked by closing the connection
+            handler.close_connection = True
+        handler.end_headers()
+        handler.responseStarted = True
+        body = bytearray() if cache != None and r.status_code == 200 and encoding == None else None
+        def keep(data):
+            nonlocal body
+            if body != None:
+                body += data
+                if len(body) > maxCachedBytes:
+                    body = None
+        # the raw response is read, so the body is passed on exactly as it was received
+        try:
+            copied = ChunkedWriter(handler, False, forwardChunkSize).copy_from(r.raw, sink=keep if body != None else None)
+        except Exception:
+            # the client has part of the body, so the only way to tell it is to hang up
+            handler.close_connection = True
+            raise
+        if length != None and copied != int(length):
+            # the upstream connection broke, and the client must not wait for the rest
+            handler.close_connection = True
+            body = None
+    if body != None:
+        body = bytes(body)
+        cache.put(cacheKey, (contentType, body), ttl, len(body))
 
 # Files that can be served to the client, with their associated MIME types
 allowedFiles = {
@@ -816,8 +2914,56 @@ allowedFiles = {
     '/scripts.js':              'text/javascript',
 }
 
+# Idle keep-alive connections are closed after this many seconds
+keepAliveTimeout = 60
+
 class MyRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Keep connections open between requests, so that a page and all of its
+    # thumbnails can be loaded over one connection. Every response has either a
+    # Content-Length or chunked encoding, or closes the connection when it ends.
+    protocol_version = 'HTTP/1.1'
+    timeout = keepAliveTimeout
+    # Streamed pages are sent in several small writes, which would otherwise be
+    # held back until the client acknowledges the previous one
+    disable_nagle_algorithm = True
+
+    # Checks if the client has closed the connection
+    def client_gone(self):
+        try:
+            (readable, _, _) = select.select([self.connection], [], [], 0)
+            return len(readable) > 0 and self.connection.recv(1, socket.MSG_PEEK) == b''
+        except OSError:
+            return True
+
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+
+    def end_headers(self):
+        if getattr(self, 'profileId', None) != None:
+            self.send_header('X-Profile-Id', self.profileId)
+        super().end_headers()
+
     def do_GET(self):
+        global requestsInProgress
+        route = route_of(self.path)
+        startTime = time.monotonic()
+        self.status = None
+        with requestCountsLock:
+            requestsInProgress += 1
+        try:
+            run_profiled(self, self.route_request)
+        finally:
+            requestSeconds.observe((route,), time.monotonic() - startTime)
+            with requestCountsLock:
+                requestsInProgress -= 1
+                requestCounts[(route, self.status or 0)] += 1
+
+    def route_request(self):
+        # set once the status has been sent, after which errors can't be reported with one
+        self.responseStarted = False
+        if recording != None and recording.recording:
+            recording.log_path(self.path)
         try:
             arr = self.path.split('?')
             path  = arr[0]
@@ -825,27 +2971,26 @@ class MyRequestHandler(http.server.BaseHTTPRequestHandler):
             params = urllib.parse.parse_qs(query) if len(arr) > 1 else {}
             # Home page
             if path == '/':
-                serve_main_page(self)
+                serve_main_page(self, params)
             # Files
             elif path in allowedFiles:
                 serve_file(self, path, allowedFiles[path])
             # Flash video converter
             elif path == '/flvconvert.flv':
-                if False:
-                    serve_file(self, 'test.flv')
-                else:
-                    query = self.path.split('?', 1)[1]
-                    if not query.startswith('src='):
-                        raise Error404
-                    url = query[4:]
-                    print('url: %s' % url)
-                    serve_flv(self, url)
+                if 'v' not in params:
+                    raise Error404
+                # the player sends start= with nothing after it to play from the beginning
+                try:
+                    start = int(params['start'][0]) if 'start' in params else 0
+                except ValueError:
+                    raise Error404
+                serve_flv(self, params['v'][0], params['fmt'][0] if 'fmt' in params else '18', max(0, start))
             # Results page
             elif path == '/results':
                 if 'search_query' in params:
                     serve_results_page(self, params, query)
                 else:
-                    serve_main_page(self)
+                    serve_main_page(self, params)
             # Watch page
             elif path == '/watch':
                 if 'v' in params:
@@ -866,18 +3011,217 @@ class MyRequestHandler(http.server.BaseHTTPRequestHandler):
             # Channel page
             elif path.startswith('/channel/') or path.startswith('/@'):
                 serve_channel_page(self, path, params)
-            # Forward caption requests to YouTube. (These can't be cross-origin for some reason)
+            # Captions
             elif path == '/api/timedtext':
-                forward_request(self, 'youtube.com', path, params)
+                serve_captions(self, params)
+            # Thumbnails
+            elif path.startswith('/thumb/'):
+                serve_thumbnail(self, path)
+            # Metrics
+            elif path == '/metrics':
+                serve_metrics(self)
+            # Saved profiles
+            elif path == '/profile':
+                serve_profile(self, params)
             else:
                 raise Error404('unknown path ' + path)
+        # The exception is passed on so that it gets logged, which also closes the
+        # connection, so the client is told not to send any more requests on it
         except Error404:
-            serve_page(self, 404, '<html><body><p>404 Not Found</p></body></html>'.encode(encoding='utf-8'))
+            self.close_connection = True
+            if not self.responseStarted:
+                serve_page(self, 404, '<html><body><p>404 Not Found</p></body></html>'.encode(encoding='utf-8'))
+            raise
+        except Error503:
+            self.close_connection = True
+            serve_page(self, 503, '<html><body><p>503 Service Unavailable</p></body></html>'.encode(encoding='utf-8'))
             raise
         except Exception:
-            serve_page(self, 500, '<html><body><p>500 Internal Server Error</p></body></html>'.encode(encoding='utf-8'))
+            self.close_connection = True
+            if not self.responseStarted:
+                serve_page(self, 500, '<html><body><p>500 Internal Server Error</p></body></html>'.encode(encoding='utf-8'))
             raise
 
-port = int(sys.argv[1]) if len(sys.argv) >= 2 else 80
-with http.server.ThreadingHTTPServer(('', port), MyRequestHandler) as server:
-    server.serve_forever()
+##### Async Server #####
+
+# Number of threads that requests are handled on in async mode. Everything a
+# route does (yt-dlp, upstream requests, ffmpeg pipes) blocks, so it runs here
+# while the sockets themselves are handled by the event loop.
+asyncWorkers = 32
+# Maximum number of requests handled at once for each route. Requests beyond
+# this wait for their turn without taking up a worker.
+asyncRouteLimits = {
+    'home':     8,
+    'static':   16,
+    'flv':      8,
+    'results':  8,
+    'watch':    8,
+    'comments': 4,
+    'playlist': 4,
+    'channel':  8,
+    'captions': 8,
+    'thumb':    16,
+    'metrics':  2,
+    'profile':  2,
+    'other':    8,
+}
+
+# Returns the name of the route that a path is handled by
+def route_of(path):
+    path = path.split('?')[0]
+    if path == '/':
+        return 'home'
+    if path in allowedFiles:
+        return 'static'
+    if path == '/flvconvert.flv':
+        return 'flv'
+    if path == '/results':
+        return 'results'
+    if path == '/watch' or path.startswith('/shorts/'):
+        return 'watch'
+    if path == '/comments':
+        return 'comments'
+    if path == '/playlist':
+        return 'playlist'
+    if path.startswith('/channel/') or path.startswith('/@'):
+        return 'channel'
+    if path == '/api/timedtext':
+        return 'captions'
+    if path.startswith('/thumb/'):
+        return 'thumb'
+    if path == '/metrics':
+        return 'metrics'
+    if path == '/profile':
+        return 'profile'
+    return 'other'
+
+# Stands in for the socket file that responses are written to. Writes are
+# handed to the event loop, and block the worker until the data has been
+# accepted by the transport, so that a slow client slows down the worker
+# rather than filling up memory.
+class AsyncSocketWriter(io.RawIOBase):
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+
+    def writable(self):
+        return True
+
+    # The data is not copied, since it is only used until this returns
+    def write(self, data):
+        asyncio.run_coroutine_threadsafe(self.send([data]), self.loop).result()
+        return len(data)
+
+    # Writes several buffers with a single trip through the loop
+    def writelines(self, buffers):
+        asyncio.run_coroutine_threadsafe(self.send(buffers), self.loop).result()
+
+    async def send(self, buffers):
+        if self.writer.is_closing():
+            raise BrokenPipeError
+        self.writer.writelines(buffers)
+        await self.writer.drain()
+
+# Handles one request that has already been read by the event loop. The request
+# is parsed and dispatched by MyRequestHandler as usual, reading it from memory
+# and writing the response through the loop.
+class AsyncRequestHandler(MyRequestHandler):
+    def __init__(self, head, loop, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.client_address = writer.get_extra_info('peername')
+        self.server = None
+        # no real socket, so ChunkedWriter falls back to wfile
+        self.connection = None
+        self.rfile = io.BytesIO(head)
+        self.wfile = AsyncSocketWriter(loop, writer)
+        self.close_connection = True
+
+    def client_gone(self):
+        return self.writer.is_closing() or self.reader.at_eof()
+
+async def handle_async_connection(reader, writer):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), keepAliveTimeout)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                break
+            requestLine = head.split(b' ', 2)
+            route = route_of(requestLine[1].decode('latin-1')) if len(requestLine) == 3 else 'other'
+            handler = AsyncRequestHandler(head, loop, reader, writer)
+            async with asyncRouteSemaphores[route]:
+                await loop.run_in_executor(asyncExecutor, handler.handle_one_request)
+            if handler.close_connection:
+                break
+    except ConnectionError:
+        pass
+    except Exception:
+        # report it the same way as socketserver does in threaded mode
+        print('-' * 40, file=sys.stderr)
+        print('Exception occurred during processing of request from', writer.get_extra_info('peername'), file=sys.stderr)
+        traceback.print_exc()
+        print('-' * 40, file=sys.stderr)
+    finally:
+        writer.close()
+
+async def serve_async(port):
+    server = await asyncio.start_server(handle_async_connection, port=port)
+    async with server:
+        await server.serve_forever()
+
+def run_async_server(port, workers):
+    global asyncExecutor, asyncRouteSemaphores
+    asyncExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='request')
+    asyncRouteSemaphores = {route: asyncio.Semaphore(limit) for (route, limit) in asyncRouteLimits.items()}
+    asyncio.run(serve_async(port))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs a web server that acts as a simple frontend to YouTube.')
+    parser.add_argument('port', type=int, nargs='?', default=80, help='port to listen on (default: 80)')
+    parser.add_argument('--async', dest='asyncMode', action='store_true',
+        help='handle connections with asyncio, with a fixed number of worker threads and per-route limits')
+    parser.add_argument('--workers', type=int, default=asyncWorkers,
+        help='number of worker threads in async mode (default: %i)' % asyncWorkers)
+    parser.add_argument('--small-thumbnails', action='store_true',
+        help='serve small re-encoded thumbnails, for slow devices')
+    parser.add_argument('--record', metavar='DIR',
+        help='save everything fetched from YouTube to DIR, along with the pages requested')
+    parser.add_argument('--replay', metavar='DIR',
+        help='serve everything from a recording in DIR instead of fetching it from YouTube')
+    parser.add_argument('--replay-latency', action='store_true',
+        help='when replaying, take as long to respond as YouTube did')
+    parser.add_argument('--innertube', action='store_true',
+        help="fetch the home page and search results from YouTube's JSON API instead of its HTML pages")
+    parser.add_argument('--innertube-url', metavar='URL', default=innertubeBaseUrl,
+        help='where to send JSON API requests (default: %s)' % innertubeBaseUrl)
+    parser.add_argument('--profile', metavar='TOKEN',
+        help='profile requests that have this token in an X-Profile-Token header or a profile= parameter')
+    parser.add_argument('--profile-dir', metavar='DIR', default=profileDir,
+        help='where to save profiles (default: %s)' % profileDir)
+    args = parser.parse_args()
+    smallThumbnails = args.small_thumbnails
+    innertubeMode = args.innertube
+    innertubeBaseUrl = args.innertube_url.rstrip('/')
+    if args.record and args.replay:
+        parser.error('--record and --replay cannot be used together')
+    elif args.record:
+        recording = Recording(args.record, False)
+    elif args.replay:
+        recording = Recording(args.replay, True, args.replay_latency)
+    if args.profile:
+        profileToken = args.profile
+        profileDir = args.profile_dir
+        os.makedirs(profileDir, exist_ok=True)
+    load_static_files()
+    init_flv_cache()
+    init_thumb_cache()
+    if recording == None or recording.recording:
+        for pool in ydlPools.values():
+            pool.fill()
+    if args.asyncMode:
+        run_async_server(args.port, args.workers)
+    else:
+        with http.server.ThreadingHTTPServer(('', args.port), MyRequestHandler) as server:
+            server.serve_forever()